@@ -1,5 +1,6 @@
 import os
 import sys
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения из .env файла
@@ -26,7 +27,11 @@ MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "telegram_bot")
 
 # Настройки бота
+# Часовой пояс, в котором администраторы указывают и видят время (рассылки, конкурсы)
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+# Максимальное число запланированных рассылок, отправляемых одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))
 DEFAULT_WELCOME_MESSAGE = os.getenv(
     "DEFAULT_WELCOME_MESSAGE", 
     "Добро пожаловать в наш канал! Вы успешно подписались."
@@ -38,6 +43,7 @@ INVITE_LINKS_COLLECTION = "invite_links"
 BROADCASTS_COLLECTION = "broadcasts"
 CONTESTS_COLLECTION = "contests"
 CONTEST_PARTICIPANTS_COLLECTION = "contest_participants"
+MIGRATIONS_COLLECTION = "migrations"
 
 # Антифрод
 MIN_ACCOUNT_AGE_DAYS = 0
@@ -4,7 +4,7 @@
 
 import logging
 import motor.motor_asyncio
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, OperationFailure
 
 from bot.config.config import (
     MONGODB_URI,
@@ -43,9 +43,17 @@ async def init_db():
 async def _ensure_indexes(db) -> None:
     """Создание индексов для всех коллекций (idempotent)."""
     await db[USERS_COLLECTION].create_index("user_id", unique=True)
-    await db[USERS_COLLECTION].create_index("status")
     await db[USERS_COLLECTION].create_index([("status", 1), ("source", 1)])
     await db[USERS_COLLECTION].create_index([("status", 1), ("city", 1)])
+    # Покрывающий индекс для потокового чтения получателей рассылки (фильтр по статусу, только user_id)
+    await db[USERS_COLLECTION].create_index([("status", 1), ("user_id", 1)])
+    # Одиночный индекс по status избыточен: status — префикс составных индексов выше
+    try:
+        await db[USERS_COLLECTION].drop_index("status_1")
+        logging.info("Удален избыточный индекс users.status_1")
+    except OperationFailure:
+        # Индекса нет (новая база или он уже удален)
+        pass
 
     await db[BROADCASTS_COLLECTION].create_index([("status", 1), ("schedule_time", 1)])
 
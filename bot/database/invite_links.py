@@ -5,9 +5,13 @@
 import logging
 import uuid
 from datetime import datetime
+from pymongo.errors import DuplicateKeyError
 from bot.database.db import get_db
 from bot.config.config import INVITE_LINKS_COLLECTION, CHANNEL_USERNAME
 
+# Количество попыток сгенерировать свободный link_id
+LINK_ID_ATTEMPTS = 3
+
 async def create_invite_link(source, created_by, description=None, expire_date=None):
     """
     Создание новой пригласительной ссылки для открытого канала
@@ -26,30 +30,42 @@ async def create_invite_link(source, created_by, description=None, expire_date=N
     
     now = datetime.utcnow()
     
-    # Генерируем уникальный ID для ссылки
-    link_id = str(uuid.uuid4())[:8]  # Короткий уникальный ID
-    
-    # Формируем ссылку с параметром start
-    if CHANNEL_USERNAME:
-        username = CHANNEL_USERNAME.lstrip('@')
-        invite_link = f"https://t.me/{username}?start=link_{link_id}"
+    # Короткий ID может совпасть с существующим (уникальный индекс link_id),
+    # в этом случае генерируем новый и повторяем вставку
+    for attempt in range(LINK_ID_ATTEMPTS):
+        # Генерируем уникальный ID для ссылки
+        link_id = str(uuid.uuid4())[:8]  # Короткий уникальный ID
+        
+        # Формируем ссылку с параметром start
+        if CHANNEL_USERNAME:
+            username = CHANNEL_USERNAME.lstrip('@')
+            invite_link = f"https://t.me/{username}?start=link_{link_id}"
+        else:
+            invite_link = f"https://t.me/your_channel?start=link_{link_id}"
+        
+        link_data = {
+            "link_id": link_id,
+            "invite_link": invite_link,
+            "source": source,
+            "created_by": created_by,
+            "description": description,
+            "expire_date": expire_date,
+            "created_at": now,
+            "updated_at": now,
+            "uses_count": 0,
+            "is_active": True
+        }
+        
+        try:
+            await collection.insert_one(link_data)
+            break
+        except DuplicateKeyError:
+            logging.warning(f"ID ссылки {link_id} уже занят, попытка {attempt + 1}/{LINK_ID_ATTEMPTS}")
+            # insert_one добавляет _id в словарь, для новой попытки он не нужен
+            link_data.pop("_id", None)
     else:
-        invite_link = f"https://t.me/your_channel?start=link_{link_id}"
-    
-    link_data = {
-        "link_id": link_id,
-        "invite_link": invite_link,
-        "source": source,
-        "created_by": created_by,
-        "description": description,
-        "expire_date": expire_date,
-        "created_at": now,
-        "updated_at": now,
-        "uses_count": 0,
-        "is_active": True
-    }
+        raise RuntimeError("Не удалось сгенерировать уникальный ID пригласительной ссылки")
     
-    result = await collection.insert_one(link_data)
     logging.info(f"Создана новая пригласительная ссылка: {invite_link} (источник: {source})")
     return link_data
 
@@ -2,23 +2,34 @@
 Модуль для работы с пользователями в базе данных
 """
 
+import json
 import logging
+import time
 from datetime import datetime
+from pymongo import ReturnDocument, UpdateMany
 from bot.database.db import get_db
 from bot.config.config import USERS_COLLECTION
 
-async def add_user(user_id, username=None, first_name=None, last_name=None, source=None, status="pending", city=None):
+# Кэш подсчета пользователей по фильтру: ключ фильтра -> (время подсчета, количество)
+_count_cache: dict[str, tuple[float, int]] = {}
+
+async def add_user(user_id, username=None, first_name=None, last_name=None, source=None, status="pending", city=None, **set_fields):
     """
     Добавление нового пользователя в базу данных или обновление существующего
     
+    Выполняется одним upsert-запросом: условия "не перезаписывать город"
+    и "активировать только неактивного" вычисляются на стороне MongoDB.
+    
     Args:
         user_id (int): Telegram ID пользователя
         username (str, optional): Имя пользователя в Telegram
         first_name (str, optional): Имя пользователя
         last_name (str, optional): Фамилия пользователя
-        source (str, optional): Источник, откуда пришел пользователь
+        source (str, optional): Источник, откуда пришел пользователь (перезаписывает прежний)
         status (str, optional): Статус пользователя (pending, active, blocked)
         city (str, optional): Город проживания пользователя
+        **set_fields: Дополнительные поля, которые записываются в том же запросе
+            (например, last_interaction)
         
     Returns:
         dict: Данные добавленного/обновленного пользователя
@@ -28,60 +39,42 @@ async def add_user(user_id, username=None, first_name=None, last_name=None, sour
     
     now = datetime.utcnow()
     
-    # Проверяем, существует ли пользователь
-    existing_user = await collection.find_one({"user_id": user_id})
+    # Значения оборачиваем в $literal, чтобы строки вида "$..." не считались путями полей
+    fields = {
+        "username": {"$literal": username},
+        "first_name": {"$literal": first_name},
+        "last_name": {"$literal": last_name},
+        "updated_at": {"$literal": now},
+        "created_at": {"$ifNull": ["$created_at", {"$literal": now}]},
+        # Новый источник (переход по ссылке) заменяет старый, без источника сохраняем прежний
+        "source": {"$ifNull": [{"$literal": source}, "$source"]},
+    }
     
-    if existing_user:
-        # Обновляем существующего пользователя
-        update_data = {
-            "$set": {
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "updated_at": now
-            }
+    # Город записываем только если он не был указан ранее
+    if city:
+        fields["city"] = {"$ifNull": ["$city", {"$literal": city}]}
+    
+    if status == "active":
+        # Дату активации обновляем только при переходе в статус active
+        fields["activated_at"] = {
+            "$cond": [{"$eq": ["$status", "active"]}, "$activated_at", {"$literal": now}]
         }
-        
-        # Обновляем статус только если он не был активным
-        if existing_user.get("status") != "active" and status == "active":
-            update_data["$set"]["status"] = status
-            update_data["$set"]["activated_at"] = now
-            
-        # Если источник не был указан ранее и указан сейчас
-        if not existing_user.get("source") and source:
-            update_data["$set"]["source"] = source
-            
-        # Если город не был указан ранее и указан сейчас
-        if not existing_user.get("city") and city:
-            update_data["$set"]["city"] = city
-            
-        await collection.update_one({"user_id": user_id}, update_data)
-        updated_user = await collection.find_one({"user_id": user_id})
-        logging.info(f"Пользователь обновлен: {user_id}")
-        return updated_user
+        fields["status"] = {"$literal": status}
     else:
-        # Добавляем нового пользователя
-        user_data = {
-            "user_id": user_id,
-            "username": username,
-            "first_name": first_name,
-            "last_name": last_name,
-            "source": source,
-            "status": status,
-            "created_at": now,
-            "updated_at": now
-        }
-        
-        # Добавляем город, если он указан
-        if city:
-            user_data["city"] = city
-            
-        if status == "active":
-            user_data["activated_at"] = now
-            
-        result = await collection.insert_one(user_data)
-        logging.info(f"Новый пользователь добавлен: {user_id}")
-        return user_data
+        # Статус задается только новому пользователю
+        fields["status"] = {"$ifNull": ["$status", {"$literal": status}]}
+    
+    for key, value in set_fields.items():
+        fields[key] = {"$literal": value}
+    
+    user = await collection.find_one_and_update(
+        {"user_id": user_id},
+        [{"$set": fields}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    logging.info(f"Пользователь добавлен/обновлен: {user_id}")
+    return user
 
 async def get_user(user_id):
     """
@@ -111,12 +104,14 @@ async def update_user(user_id, update_data):
     db = get_db()
     collection = db[USERS_COLLECTION]
     
+    now = datetime.utcnow()
+    
     # Добавляем дату обновления
-    update_data["updated_at"] = datetime.utcnow()
+    update_data["updated_at"] = now
     
     # Если устанавливается статус active, добавляем дату активации
     if update_data.get("status") == "active":
-        update_data["activated_at"] = datetime.utcnow()
+        update_data["activated_at"] = now
     
     result = await collection.update_one(
         {"user_id": user_id},
@@ -125,7 +120,7 @@ async def update_user(user_id, update_data):
     
     return result.modified_count > 0
 
-async def get_all_users(status=None, limit=None, skip=0):
+async def get_all_users(status=None, limit=None, skip=0, projection=None):
     """
     Получение списка всех пользователей с возможностью фильтрации по статусу
     
@@ -133,6 +128,7 @@ async def get_all_users(status=None, limit=None, skip=0):
         status (str, optional): Статус пользователей для фильтрации
         limit (int, optional): Ограничение количества результатов
         skip (int, optional): Сколько пользователей пропустить (для пагинации)
+        projection (dict, optional): Набор возвращаемых полей (по умолчанию все поля)
         
     Returns:
         list: Список пользователей
@@ -144,7 +140,7 @@ async def get_all_users(status=None, limit=None, skip=0):
     if status:
         query["status"] = status
     
-    cursor = collection.find(query).skip(skip)
+    cursor = collection.find(query, projection).skip(skip)
     
     if limit:
         cursor = cursor.limit(limit)
@@ -163,7 +159,7 @@ async def get_all_users(status=None, limit=None, skip=0):
     
     return users
 
-async def get_users_by_filter(filter_query, limit=None, skip=0):
+async def get_users_by_filter(filter_query, limit=None, skip=0, projection=None):
     """
     Получение пользователей по произвольному фильтру
     
@@ -171,6 +167,7 @@ async def get_users_by_filter(filter_query, limit=None, skip=0):
         filter_query (dict): Фильтр для поиска пользователей
         limit (int, optional): Ограничение количества результатов
         skip (int, optional): Сколько пользователей пропустить (для пагинации)
+        projection (dict, optional): Набор возвращаемых полей (по умолчанию все поля)
         
     Returns:
         list: Список пользователей, соответствующих фильтру
@@ -180,7 +177,7 @@ async def get_users_by_filter(filter_query, limit=None, skip=0):
     
     logging.info(f"Поиск пользователей по фильтру: {filter_query}")
     
-    cursor = collection.find(filter_query).skip(skip)
+    cursor = collection.find(filter_query, projection).skip(skip)
     
     if limit:
         cursor = cursor.limit(limit)
@@ -190,6 +187,58 @@ async def get_users_by_filter(filter_query, limit=None, skip=0):
     
     return result
 
+def get_users_cursor(filter_query=None, projection=None, batch_size=None):
+    """
+    Получение курсора MongoDB для потокового чтения пользователей без загрузки всего списка в память
+    
+    Args:
+        filter_query (dict, optional): Фильтр для поиска пользователей
+        projection (dict, optional): Набор возвращаемых полей (например, {"user_id": 1, "_id": 0})
+        batch_size (int, optional): Количество документов, получаемых за один запрос к серверу
+        
+    Returns:
+        AsyncIOMotorCursor: Курсор для итерации через async for
+    """
+    db = get_db()
+    collection = db[USERS_COLLECTION]
+    
+    cursor = collection.find(filter_query or {}, projection)
+    
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    
+    return cursor
+
+async def count_users_by_filter(filter_query):
+    """Подсчёт количества пользователей по произвольному фильтру на стороне MongoDB."""
+    db = get_db()
+    return await db[USERS_COLLECTION].count_documents(filter_query)
+
+async def count_users_by_filter_cached(filter_query, ttl=30):
+    """
+    Подсчёт количества пользователей по фильтру с кэшированием результата
+    
+    Подходит для отображения размера аудитории администратору: в одном сценарии
+    рассылки один и тот же фильтр подсчитывается несколько раз подряд.
+    
+    Args:
+        filter_query (dict): Фильтр для поиска пользователей
+        ttl (int, optional): Время жизни результата в секундах
+        
+    Returns:
+        int: Количество пользователей
+    """
+    key = json.dumps(filter_query, sort_keys=True, default=str)
+    now = time.monotonic()
+    
+    cached = _count_cache.get(key)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    
+    count = await count_users_by_filter(filter_query)
+    _count_cache[key] = (now, count)
+    return count
+
 async def update_user_status(user_id, status, reason=None):
     """
     Обновление статуса пользователя с указанием причины
@@ -205,9 +254,11 @@ async def update_user_status(user_id, status, reason=None):
     db = get_db()
     collection = db[USERS_COLLECTION]
     
+    now = datetime.utcnow()
+    
     update_data = {
         "status": status,
-        "updated_at": datetime.utcnow()
+        "updated_at": now
     }
     
     # Добавляем причину изменения статуса, если она указана
@@ -216,11 +267,11 @@ async def update_user_status(user_id, status, reason=None):
     
     # Если устанавливается статус active, добавляем дату активации
     if status == "active":
-        update_data["activated_at"] = datetime.utcnow()
+        update_data["activated_at"] = now
     
     # Если устанавливается статус inactive, добавляем дату деактивации
     if status == "inactive":
-        update_data["deactivated_at"] = datetime.utcnow()
+        update_data["deactivated_at"] = now
     
     result = await collection.update_one(
         {"user_id": user_id},
@@ -231,6 +282,44 @@ async def update_user_status(user_id, status, reason=None):
     return result.modified_count > 0
 
 
+async def mark_users_blocked(users_by_reason):
+    """
+    Массовая пометка пользователей, которым невозможно доставить сообщение
+    (заблокировали бота, удалили аккаунт и т.п.)
+    
+    Такие пользователи получают статус blocked и не попадают в рассылки
+    по активным пользователям. При повторном /start статус снова станет active.
+    
+    Args:
+        users_by_reason (dict): Причина (тип ошибки Telegram API) -> список Telegram ID
+        
+    Returns:
+        int: Количество обновленных пользователей
+    """
+    now = datetime.utcnow()
+    # Одна операция на причину, все операции отправляются одним запросом
+    operations = [
+        UpdateMany(
+            {"user_id": {"$in": list(user_ids)}},
+            {"$set": {
+                "status": "blocked",
+                "status_reason": reason,
+                "blocked_at": now,
+                "updated_at": now
+            }}
+        )
+        for reason, user_ids in users_by_reason.items() if user_ids
+    ]
+    if not operations:
+        return 0
+    
+    db = get_db()
+    result = await db[USERS_COLLECTION].bulk_write(operations, ordered=False)
+    
+    logging.info(f"Помечено недоступными {result.modified_count} пользователей (Причины: {', '.join(users_by_reason)})")
+    return result.modified_count
+
+
 async def count_users(status: str | None = None) -> int:
     """Подсчёт количества пользователей (опционально по статусу) без загрузки в RAM."""
     db = get_db()
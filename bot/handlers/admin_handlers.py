@@ -4,21 +4,24 @@
 
 import logging
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher.filters import Text, IDFilter
-import pytz
 
-from bot.config.config import ADMIN_USER_IDS, CHANNEL_ID
+from bot.config.config import ADMIN_USER_IDS, CHANNEL_ID, MOSCOW_TZ
 from bot.database import (
     get_all_users, 
-    get_users_by_filter
+    count_users_by_filter_cached
 )
 from bot.database.users import count_users, get_city_stats
 from bot.services.notifications import send_broadcast, schedule_broadcast
 
+# Ответ на подтверждение рассылки, при котором сообщения отправляются без звука
+SILENT_CONFIRMATION = "тихо"
+
+
 class BroadcastStates(StatesGroup):
     """
     Состояния для FSM при создании рассылки
@@ -174,7 +177,7 @@ async def show_target_selection(message, state: FSMContext, page=0, filter_type=
     """
     # Получаем активных пользователей и их источники или города
     filters = {}
-    active_users = await get_all_users(status="active")
+    active_users = await get_all_users(status="active", projection={filter_type: 1, "_id": 0})
     
     # Собираем уникальные источники или города и количество пользователей
     for user in active_users:
@@ -322,20 +325,17 @@ async def process_broadcast_target(callback_query: types.CallbackQuery, state: F
         data["target_description"] = target_description
         
         # Получаем количество активных пользователей для рассылки
-        if target_filter:
-            # Всегда добавляем статус "active"
-            combined_filter = target_filter.copy()
-            combined_filter["status"] = "active"
-            users = await get_users_by_filter(combined_filter)
-        else:
-            users = await get_all_users(status="active")
+        # Всегда добавляем статус "active"; количество считается на стороне MongoDB
+        combined_filter = target_filter.copy() if target_filter else {}
+        combined_filter["status"] = "active"
+        users_count = await count_users_by_filter_cached(combined_filter)
         
-        logging.info(f"Найдено {len(users)} активных пользователей для рассылки с фильтром: {target_filter}")
+        logging.info(f"Найдено {users_count} активных пользователей для рассылки с фильтром: {target_filter}")
         
         # Формируем сообщение для подтверждения
         confirmation_message = (
             f"Вы собираетесь отправить следующее сообщение {target_description} "
-            f"(всего {len(users)} активных пользователей):\n\n"
+            f"(всего {users_count} активных пользователей):\n\n"
             f"{data['message_text']}"
         )
         
@@ -349,7 +349,7 @@ async def process_broadcast_target(callback_query: types.CallbackQuery, state: F
             
             confirmation_message += f"\n\nСообщение будет отправлено с {media_type_text}."
         
-        confirmation_message += "\n\nПодтвердите отправку (да/нет):"
+        confirmation_message += f"\n\nПодтвердите отправку (да/нет, «{SILENT_CONFIRMATION}» — отправить без звука):"
     
     await callback_query.message.answer(confirmation_message)
     await BroadcastStates.waiting_for_confirmation.set()
@@ -358,7 +358,10 @@ async def process_broadcast_confirmation(message: types.Message, state: FSMConte
     """
     Обрабатывает подтверждение отправки рассылки
     """
-    if message.text.lower() in ["да", "yes", "y", "д"]:
+    answer = message.text.lower()
+    if answer in ["да", "yes", "y", "д", SILENT_CONFIRMATION]:
+        # Ответ «тихо» подтверждает рассылку без звукового уведомления у получателей
+        disable_notification = answer == SILENT_CONFIRMATION
         async with state.proxy() as data:
             message_text = data["message_text"]
             target_filter = data.get("target_filter")
@@ -375,7 +378,8 @@ async def process_broadcast_confirmation(message: types.Message, state: FSMConte
             message_text=message_text, 
             target_filter=target_filter,
             media=media,
-            media_type=media_type
+            media_type=media_type,
+            disable_notification=disable_notification
         )
         
         # Отправляем отчет о результатах
@@ -479,8 +483,8 @@ async def show_scheduled_target_selection(message, state: FSMContext, page=0, fi
         page (int): Номер страницы для пагинации (начиная с 0)
         filter_type (str): Тип фильтра ("source" или "city")
     """
-    # Получаем активных пользователей и информацию о них
-    active_users = await get_all_users(status="active")
+    # Получаем активных пользователей и информацию о них (только нужные поля)
+    active_users = await get_all_users(status="active", projection={"source": 1, "city": 1, "_id": 0})
     
     # Определяем, какие данные показывать (источники или города)
     if filter_type == "source":
@@ -648,19 +652,16 @@ async def process_scheduled_broadcast_target(callback_query: types.CallbackQuery
         data["target_description"] = target_description
         
         # Получаем количество активных пользователей для рассылки
-        if target_filter:
-            # Всегда добавляем статус "active"
-            combined_filter = target_filter.copy()
-            combined_filter["status"] = "active"
-            users = await get_users_by_filter(combined_filter)
-        else:
-            users = await get_all_users(status="active")
+        # Всегда добавляем статус "active"; количество считается на стороне MongoDB
+        combined_filter = target_filter.copy() if target_filter else {}
+        combined_filter["status"] = "active"
+        users_count = await count_users_by_filter_cached(combined_filter)
         
-        logging.info(f"Найдено {len(users)} активных пользователей для запланированной рассылки с фильтром: {target_filter}")
+        logging.info(f"Найдено {users_count} активных пользователей для запланированной рассылки с фильтром: {target_filter}")
     
     # Просим пользователя указать время для планирования рассылки
     await callback_query.message.answer(
-        f"Вы выбрали отправку сообщения {target_description} (всего {len(users)} активных пользователей).\n\n"
+        f"Вы выбрали отправку сообщения {target_description} (всего {users_count} активных пользователей).\n\n"
         "Теперь укажите дату и время для отправки рассылки в формате ДД.ММ.ГГГГ ЧЧ:ММ\n"
         "*ВНИМАНИЕ! Время указывается обязательно по московскому времени (МСК).*\n"
         "Например: 25.12.2023 15:30",
@@ -678,8 +679,7 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
         schedule_time = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
         
         # Получаем текущее время в московском часовом поясе для корректного сравнения
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        current_time_moscow = datetime.now(pytz.UTC).astimezone(moscow_tz).replace(tzinfo=None)
+        current_time_moscow = datetime.now(timezone.utc).astimezone(MOSCOW_TZ).replace(tzinfo=None)
         
         # Проверяем, что дата в будущем (сравниваем московское время с московским)
         if schedule_time <= current_time_moscow:
@@ -693,18 +693,15 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
             
             # Получаем количество активных пользователей для рассылки
             target_filter = data.get("target_filter")
-            if target_filter:
-                # Всегда добавляем статус "active"
-                combined_filter = target_filter.copy()
-                combined_filter["status"] = "active"
-                users = await get_users_by_filter(combined_filter)
-            else:
-                users = await get_all_users(status="active")
+            # Всегда добавляем статус "active"; количество считается на стороне MongoDB
+            combined_filter = target_filter.copy() if target_filter else {}
+            combined_filter["status"] = "active"
+            users_count = await count_users_by_filter_cached(combined_filter)
             
             # Формируем сообщение для подтверждения
             confirmation_message = (
                 f"Вы собираетесь запланировать отправку следующего сообщения {target_description} "
-                f"(всего {len(users)} пользователей) на {schedule_time.strftime('%d.%m.%Y в %H:%M')} (по Московскому времени):\n\n"
+                f"(всего {users_count} пользователей) на {schedule_time.strftime('%d.%m.%Y в %H:%M')} (по Московскому времени):\n\n"
                 f"{data['message_text']}"
             )
             
@@ -718,7 +715,7 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
                 
                 confirmation_message += f"\n\nСообщение будет отправлено с {media_type_text}."
             
-            confirmation_message += "\n\nПодтвердите планирование (да/нет):"
+            confirmation_message += f"\n\nПодтвердите планирование (да/нет, «{SILENT_CONFIRMATION}» — отправить без звука):"
         
         await message.answer(confirmation_message)
         await BroadcastStates.waiting_for_schedule_confirmation.set()
@@ -732,7 +729,10 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
     """
     Обрабатывает подтверждение планирования рассылки
     """
-    if message.text.lower() in ["да", "yes", "y", "д"]:
+    answer = message.text.lower()
+    if answer in ["да", "yes", "y", "д", SILENT_CONFIRMATION]:
+        # Ответ «тихо» подтверждает рассылку без звукового уведомления у получателей
+        disable_notification = answer == SILENT_CONFIRMATION
         async with state.proxy() as data:
             message_text = data["message_text"]
             schedule_time = data["schedule_time"]
@@ -748,7 +748,8 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
             schedule_time=schedule_time,
             target_filter=target_filter,
             media=media,
-            media_type=media_type
+            media_type=media_type,
+            disable_notification=disable_notification
         )
         
         # Отправляем подтверждение
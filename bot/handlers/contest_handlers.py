@@ -4,15 +4,14 @@
 
 import logging
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 
-import pytz
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text, IDFilter
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
-from bot.config.config import ADMIN_USER_IDS
+from bot.config.config import ADMIN_USER_IDS, MOSCOW_TZ
 from bot.database.contests import (
     add_participant,
     create_contest,
@@ -32,11 +31,9 @@ from bot.services.contests import (
     validate_participation,
 )
 
-MOSCOW_TZ = pytz.timezone("Europe/Moscow")
-
 
 def _utc_to_msk_str(dt: datetime) -> str:
-    utc_aware = pytz.UTC.localize(dt)
+    utc_aware = dt.replace(tzinfo=timezone.utc)
     return utc_aware.astimezone(MOSCOW_TZ).strftime("%d.%m.%Y %H:%M")
 
 
@@ -128,7 +125,7 @@ async def contest_create_end_time(message: types.Message, state: FSMContext) ->
         await message.answer("Неверный формат. Используйте ДД.ММ.ГГГГ ЧЧ:ММ, например: 31.12.2026 18:00")
         return
 
-    now_msk = datetime.now(pytz.UTC).astimezone(MOSCOW_TZ).replace(tzinfo=None)
+    now_msk = datetime.now(timezone.utc).astimezone(MOSCOW_TZ).replace(tzinfo=None)
     if naive_msk <= now_msk:
         await message.answer(
             f"Дата должна быть в будущем. Сейчас по МСК: {now_msk.strftime('%d.%m.%Y %H:%M')}. Попробуйте ещё раз:"
@@ -136,8 +133,8 @@ async def contest_create_end_time(message: types.Message, state: FSMContext) ->
         return
 
     # Конвертируем МСК → UTC для хранения
-    msk_aware = MOSCOW_TZ.localize(naive_msk)
-    end_time_utc = msk_aware.astimezone(pytz.UTC).replace(tzinfo=None)
+    msk_aware = naive_msk.replace(tzinfo=MOSCOW_TZ)
+    end_time_utc = msk_aware.astimezone(timezone.utc).replace(tzinfo=None)
 
     async with state.proxy() as data:
         data["end_time_utc"] = end_time_utc
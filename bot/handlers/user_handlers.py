@@ -6,7 +6,7 @@ import asyncio
 import logging
 from datetime import datetime
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import CommandStart, Command
+from aiogram.dispatcher.filters import CommandStart, Command, Text
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import (
@@ -17,9 +17,12 @@ from aiogram.types import (
     InlineKeyboardButton,
 )
 
-from bot.database import add_user, update_user
+from bot.database import add_user, update_user, get_user, get_source_by_link
+from bot.handlers.city_handlers import ask_city
+from bot.handlers.contest_handlers import start_contest_participation
 from bot.utils.send_email import send_consultation_email
 from bot.utils.menu import get_main_menu
+from bot.utils.activity_buffer import mark_active
 
 
 class ConsultationForm(StatesGroup):
@@ -35,6 +38,14 @@ class ConsultationForm(StatesGroup):
 CONSULT_CONTACT_PHONE = "consult_contact_phone"
 CONSULT_CONTACT_CHAT = "consult_contact_chat"
 
+# Клавиатура с предложением указать город не меняется, создаем ее один раз
+_SET_CITY_KEYBOARD = InlineKeyboardMarkup().add(
+    InlineKeyboardButton('🏙️ Указать город', callback_data='set_city')
+)
+
+# Ссылки на фоновые задачи отправки писем, чтобы их не собрал сборщик мусора
+_background_tasks: set[asyncio.Task] = set()
+
 async def start_cmd(message: types.Message, state: FSMContext):
     """
     Обработчик команды /start
@@ -45,47 +56,42 @@ async def start_cmd(message: types.Message, state: FSMContext):
     """
     user = message.from_user
     
-    # Сохраняем или обновляем пользователя в базе данных
-    await add_user(
-        user_id=user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        status="active"  # Пользователи открытого канала сразу активны
-    )
-    
-    # Обновляем время последнего взаимодействия
-    await update_user(user.id, {"last_interaction": datetime.utcnow()})
-    
     # Проверяем аргументы команды для определения источника или конкурса
     args = message.get_args()
     logging.info(f"Пользователь {user.id} запустил бота с аргументами: '{args}'")
 
-    if args and args.startswith("contest_"):
-        contest_id = args.replace("contest_", "")
-        logging.info(f"Пользователь {user.id} переходит к конкурсу {contest_id}")
-        from bot.handlers.contest_handlers import start_contest_participation
-        await start_contest_participation(message, state, contest_id)
-        return
-
+    # Источник определяем до сохранения, чтобы записать его в том же запросе
     source = None
     if args and args.startswith('link_'):
         link_id = args.replace('link_', '')
         logging.info(f"Определен link_id: {link_id}")
-        from bot.database import get_source_by_link
         source = await get_source_by_link(link_id)
         logging.info(f"Получен источник: {source}")
         if source:
-            await update_user(user.id, {"source": source})
             logging.info(f"Пользователь {user.id} пришел по ссылке с источником: {source}")
         else:
             logging.warning(f"Источник не найден для link_id: {link_id}")
-    else:
+    elif not (args and args.startswith("contest_")):
         logging.info(f"Пользователь {user.id} запустил бота без параметра link_")
     
-    # Отправляем приветственное сообщение
-    from bot.config.config import CHANNEL_USERNAME
+    # Сохраняем или обновляем пользователя в базе данных
+    await add_user(
+        user_id=user.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        source=source,
+        status="active",  # Пользователи открытого канала сразу активны
+        last_interaction=datetime.utcnow()  # Время последнего взаимодействия в том же запросе
+    )
+
+    if args and args.startswith("contest_"):
+        contest_id = args.replace("contest_", "")
+        logging.info(f"Пользователь {user.id} переходит к конкурсу {contest_id}")
+        await start_contest_participation(message, state, contest_id)
+        return
     
+    # Отправляем приветственное сообщение
     welcome_text = f"""👋 Добро пожаловать в официальный Telegram-бот Arctic Trucks Россия.
 
 📢 Подписывайтесь на наш канал: https://t.me/arctictrucksru
@@ -95,12 +101,9 @@ async def start_cmd(message: types.Message, state: FSMContext):
     await message.answer(welcome_text, reply_markup=get_main_menu())
     
     # Предложение указать город
-    city_keyboard = InlineKeyboardMarkup()
-    city_keyboard.add(InlineKeyboardButton('🏙️ Указать город', callback_data='set_city'))
-    
     await message.answer(
         "💡 Из какого города Вы с нами? Нам важно знать, из каких уголков России и мира наши подписчики",
-        reply_markup=city_keyboard
+        reply_markup=_SET_CITY_KEYBOARD
     )
 
 async def help_cmd(message: types.Message):
@@ -108,7 +111,7 @@ async def help_cmd(message: types.Message):
     Обработчик команды /help
     """
     # Обновляем время последнего взаимодействия
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     
     text = (
         "Я бот для управления открытым каналом. Вот что я умею:\n\n"
@@ -127,7 +130,7 @@ async def about_cmd(message: types.Message):
     Обработчик команды /about
     """
     # Обновляем время последнего взаимодействия
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     
     text = (
         "Это открытый канал с эксклюзивным контентом.\n\n"
@@ -140,7 +143,7 @@ async def available_cmd(message: types.Message) -> None:
     """
     Обработчик команды /available
     """
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     await message.answer(
         "👉 Хотите узнать больше о моделях в наличии? Переходите на сайт https://arctictrucks.ru/auto-in-stock/"
     )
@@ -149,7 +152,7 @@ async def shop_cmd(message: types.Message) -> None:
     """
     Обработчик команды /shop
     """
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     await message.answer(
         "👉 Полезное внедорожное оборудование и запчасти! Подробности https://arctictrucks.ru/equip/"
     )
@@ -158,7 +161,7 @@ async def configurator_cmd(message: types.Message) -> None:
     """
     Обработчик команды /configurator
     """
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     await message.answer(
         "👉 Хотите собрать свой Arctic Trucks под индивидуальные задачи? Переходите на сайт https://arctictrucks.ru/configurator/"
     )
@@ -172,6 +175,8 @@ async def start_consultation_flow(
     Запускает сценарий консультации: задает первый вопрос и переводит
     пользователя в состояние ожидания текста вопроса.
     """
+    mark_active(message.from_user.id)
+
     # Сбрасываем предыдущие состояния (например, выбор города)
     await state.finish()
     await ConsultationForm.waiting_for_question.set()
@@ -186,35 +191,21 @@ async def manager_cmd(message: types.Message, state: FSMContext) -> None:
     Обработчик команды /manager
     Переводит пользователя в сценарий оставления заявки на консультацию.
     """
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
     await start_consultation_flow(message, state)
 
 
 async def any_message_handler(message: types.Message, state: FSMContext):
     """
-    Обработчик любых сообщений для отслеживания активности пользователя
+    Обработчик остальных текстовых сообщений (кнопки меню обрабатываются
+    отдельными обработчиками с фильтром по тексту)
     """
-    await update_user(message.from_user.id, {"last_interaction": datetime.utcnow()})
+    mark_active(message.from_user.id)
 
-    # Убрана логика проверки заявок на вступление для открытого канала
-    
-    # Обрабатываем текстовые сообщения
-    if message.text == "Получить консультацию":
-        await start_consultation_flow(message, state)
-    elif message.text == "Arctic Trucks в наличии":
-        # Поведение соответствует команде /available
-        await available_cmd(message)
-    elif message.text == "Интернет-магазин":
-        # Поведение соответствует команде /shop
-        await shop_cmd(message)
-    elif message.text == "Конфигуратор":
-        # Поведение соответствует команде /configurator
-        await configurator_cmd(message)
-    else:
-        await message.answer(
-            "Извините, я не понимаю эту команду. Используйте кнопки меню для навигации.",
-            reply_markup=get_main_menu()
-        )
+    await message.answer(
+        "Извините, я не понимаю эту команду. Используйте кнопки меню для навигации.",
+        reply_markup=get_main_menu()
+    )
 
 
 async def consultation_question_handler(
@@ -340,8 +331,6 @@ async def _process_consultation_submission(
         contact_method = data.get("contact_method")
 
     # Получаем город пользователя из базы
-    from bot.database import get_user
-
     user_data = await get_user(user.id)
     city = user_data.get("city") if user_data else None
 
@@ -367,6 +356,28 @@ async def _process_consultation_submission(
         )
         return False
 
+async def _send_contact_email(message: types.Message, phone: str, user_name: str, city: str | None):
+    """
+    Отправляет письмо с контактом пользователя и сообщает ему, если отправка не удалась.
+    """
+    try:
+        result = await asyncio.to_thread(
+            send_consultation_email,
+            phone_number=phone,
+            user_name=user_name,
+            city=city,
+            contact_method="Контакт отправлен через Telegram",
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при отправке email с номером {phone}: {e}")
+        result = False
+    
+    if not result:
+        await message.answer(
+            "Произошла ошибка при отправке заявки. Попробуйте позже или свяжитесь с нами другим способом.",
+            reply_markup=get_main_menu()
+        )
+
 async def contact_handler(message: types.Message):
     """
     Обработчик получения контакта пользователя (номер телефона)
@@ -379,37 +390,21 @@ async def contact_handler(message: types.Message):
             user_name += f" {message.from_user.last_name}"
         
         # Получаем город пользователя из базы данных
-        from bot.database import get_user
         user_data = await get_user(user_id)
         city = user_data.get("city") if user_data else None
         
         # Сохраняем номер телефона в базе
         await update_user(user_id, {"phone": phone})
-        try:
-            result = await asyncio.to_thread(
-                send_consultation_email,
-                phone_number=phone,
-                user_name=user_name,
-                city=city,
-                contact_method="Контакт отправлен через Telegram",
-            )
-            if result:
-                # Уведомляем пользователя
-                await message.answer(
-                    "Спасибо! Ваш номер телефона отправлен консультанту. Скоро с вами свяжутся.",
-                    reply_markup=get_main_menu()
-                )
-            else:
-                await message.answer(
-                    "Произошла ошибка при отправке заявки. Попробуйте позже или свяжитесь с нами другим способом.",
-                    reply_markup=get_main_menu()
-                )
-        except Exception as e:
-            logging.error(f"Ошибка при отправке email с номером {phone}: {e}")
-            await message.answer(
-                "Произошла ошибка при отправке заявки. Попробуйте позже или свяжитесь с нами другим способом.",
-                reply_markup=get_main_menu()
-            )
+        
+        # Письмо отправляется в фоне, пользователь получает ответ сразу, не дожидаясь SMTP
+        task = asyncio.create_task(_send_contact_email(message, phone, user_name, city))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        
+        await message.answer(
+            "Спасибо! Ваш номер телефона отправлен консультанту. Скоро с вами свяжутся.",
+            reply_markup=get_main_menu()
+        )
     else:
         await message.answer(
             "Не удалось получить номер телефона. Пожалуйста, попробуйте ещё раз.",
@@ -417,7 +412,6 @@ async def contact_handler(message: types.Message):
         )
 
 async def set_city_callback_handler(callback_query: types.CallbackQuery, state: FSMContext):
-    from bot.handlers.city_handlers import ask_city
     await callback_query.answer()
     await ask_city(callback_query.message, state)
 
@@ -453,7 +447,13 @@ def register_user_handlers(dp: Dispatcher):
         state=ConsultationForm.waiting_for_contact_choice,
     )
 
-    # Обработчик для всех текстовых сообщений (fallback, только вне состояний FSM)
+    # Кнопки главного меню: поведение соответствует командам /available, /shop, /configurator
+    dp.register_message_handler(start_consultation_flow, Text(equals="Получить консультацию"), state=None)
+    dp.register_message_handler(available_cmd, Text(equals="Arctic Trucks в наличии"), state=None)
+    dp.register_message_handler(shop_cmd, Text(equals="Интернет-магазин"), state=None)
+    dp.register_message_handler(configurator_cmd, Text(equals="Конфигуратор"), state=None)
+
+    # Обработчик для всех остальных текстовых сообщений (fallback, только вне состояний FSM)
     dp.register_message_handler(
         any_message_handler,
         content_types=types.ContentTypes.TEXT,
@@ -5,20 +5,30 @@
 import logging
 import asyncio
 from aiogram import Bot, Dispatcher, executor
-from datetime import datetime
 
 from bot.config.config import TELEGRAM_BOT_TOKEN, DEBUG
 from bot.handlers import register_all_handlers
 from bot.database import init_db, close_db_connection
 from bot.utils.logging_setup import setup_logging, clean_old_logs
-from bot.utils.scheduler import setup_scheduler, check_scheduled_broadcasts, migrate_old_broadcasts, create_broadcast_check_job
+from bot.utils.scheduler import setup_scheduler, migrate_old_broadcasts, restore_scheduled_broadcasts
 from bot.utils.mongo_storage import MongoStorage
+from bot.utils.activity_buffer import flush_activity
 
 # Настройка логирования
 setup_logging(log_level=logging.DEBUG if DEBUG else logging.INFO)
 
+# uvloop должен быть установлен до создания event loop (его создает планировщик ниже)
+try:
+    import uvloop
+    uvloop.install()
+    logging.info("Используется event loop uvloop")
+except ImportError:
+    logging.info("uvloop недоступен, используется стандартный event loop")
+
 # Инициализация бота и диспетчера
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Пул соединений рассчитан на параллельных воркеров рассылки (25) с запасом для long polling,
+# соединения переиспользуются между запросами (keep-alive)
+bot = Bot(token=TELEGRAM_BOT_TOKEN, connections_limit=50)
 storage = MongoStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -32,6 +42,12 @@ async def on_startup(dispatcher):
     Args:
         dispatcher: Dispatcher объект
     """
+    # Eager-задачи (Python 3.12+) выполняются синхронно до первого реального ожидания,
+    # что убирает лишний проход через event loop для быстро завершающихся корутин
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+        logging.info("Включена eager task factory")
+    
     # Инициализация базы данных
     await init_db()
     
@@ -45,19 +61,9 @@ async def on_startup(dispatcher):
     logging.info("Запуск миграции старых запланированных рассылок...")
     await migrate_old_broadcasts()
 
-    # Создаем функцию-обертку для передачи бота
-    check_broadcasts_job = create_broadcast_check_job(bot)
-    
-    # Добавляем задачу для проверки запланированных рассылок
-    scheduler.add_job(
-        check_broadcasts_job,
-        'interval',
-        minutes=1,
-        id='check_broadcasts',
-        replace_existing=True,
-        next_run_time=datetime.utcnow()  # Запускаем немедленно после старта
-    )
-    logging.info("Планировщик рассылок добавлен с интервалом 1 минута")
+    # Каждая запланированная рассылка - отдельная задача планировщика на свое время.
+    # Задачи хранятся в памяти, поэтому после перезапуска восстанавливаем их из базы
+    await restore_scheduled_broadcasts(bot)
     
     # Убрана задача очистки заявок на вступление - не нужна для открытого канала
     
@@ -72,6 +78,16 @@ async def on_startup(dispatcher):
     )
     logging.info("Планировщик очистки логов добавлен (интервал: 24 часа)")
     
+    # Добавляем задачу для сохранения времени последнего взаимодействия пользователей
+    scheduler.add_job(
+        flush_activity,
+        'interval',
+        seconds=30,
+        id='flush_activity',
+        replace_existing=True
+    )
+    logging.info("Планировщик сохранения активности пользователей добавлен (интервал: 30 секунд)")
+    
     logging.info("Бот запущен")
 
 async def on_shutdown(dispatcher):
@@ -81,6 +97,9 @@ async def on_shutdown(dispatcher):
     Args:
         dispatcher: Dispatcher объект
     """
+    # Сохраняем накопленную активность пользователей до закрытия соединения
+    await flush_activity()
+    
     # Закрываем соединение с базой данных
     await close_db_connection()
     
@@ -4,15 +4,12 @@
 
 import logging
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional
 
-import pytz
 from aiogram import Bot, types
 
-from bot.config.config import CHANNEL_ID, CHANNEL_USERNAME, MAX_USER_ID
-
-MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+from bot.config.config import CHANNEL_ID, CHANNEL_USERNAME, MAX_USER_ID, MOSCOW_TZ
 
 from bot.database.contests import (
     get_contest,
@@ -96,7 +93,7 @@ async def publish_contest_to_channel(
     text = (
         f"🎉 *{contest['title']}*\n\n"
         f"{contest['description']}\n\n"
-        f"⏰ Приём заявок до: {pytz.UTC.localize(contest['end_time']).astimezone(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')} МСК\n\n"
+        f"⏰ Приём заявок до: {contest['end_time'].replace(tzinfo=timezone.utc).astimezone(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')} МСК\n\n"
         "Нажмите кнопку ниже, чтобы принять участие!"
     )
 
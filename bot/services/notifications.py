@@ -5,28 +5,48 @@
 import logging
 import asyncio
 import math
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot
+from aiogram.bot import api
+from aiolimiter import AsyncLimiter
 from aiogram.types import InputFile, InputMediaPhoto, InputMediaVideo, InputMediaAnimation
 from aiogram.utils.exceptions import BotBlocked, UserDeactivated, ChatNotFound, Unauthorized, CantInitiateConversation, RetryAfter, TelegramAPIError
 
-from bot.database import get_all_users, get_users_by_filter
-from bot.config.config import BROADCASTS_COLLECTION
+from bot.database import get_users_cursor, count_users_by_filter, mark_users_blocked
+from bot.config.config import BROADCASTS_COLLECTION, MOSCOW_TZ
 from bot.database.db import get_db
 
-async def send_welcome_message(user_id, message_text):
+# Глобальный лимит Telegram 30 сообщений в секунду, оставляем запас.
+# Ограничитель общий для всех рассылок, в том числе выполняющихся одновременно
+MESSAGES_PER_SECOND = 28
+BOT_LIMITER = AsyncLimiter(MESSAGES_PER_SECOND, 1)
+
+# Время (по часам event loop), до которого отправка приостановлена после RetryAfter
+_pause_until = 0.0
+
+# Ошибки, после которых сообщение пользователю не будет доставлено и в следующий раз
+DEAD_USER_ERRORS = {"BotBlocked", "UserDeactivated", "ChatNotFound", "CantInitiateConversation"}
+
+# Тип медиа -> (метод Bot API, параметр с file_id медиа)
+_MEDIA_SENDERS = {
+    "photo": (api.Methods.SEND_PHOTO, "photo"),
+    "video": (api.Methods.SEND_VIDEO, "video"),
+    "animation": (api.Methods.SEND_ANIMATION, "animation"),
+}
+
+async def send_welcome_message(bot: Bot, user_id, message_text):
     """
     Отправка приветственного сообщения пользователю
     
     Args:
+        bot (Bot): Экземпляр бота
         user_id (int): ID пользователя
         message_text (str): Текст сообщения
         
     Returns:
         bool: True если сообщение отправлено успешно, иначе False
     """
-    from bot.main import bot  # Импортируем здесь, чтобы избежать цикличного импорта
-    
     try:
         await bot.send_message(chat_id=user_id, text=message_text)
         logging.info(f"Приветственное сообщение отправлено пользователю {user_id}")
@@ -35,7 +55,7 @@ async def send_welcome_message(user_id, message_text):
         logging.error(f"Ошибка при отправке приветственного сообщения пользователю {user_id}: {e}")
         return False
 
-async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=True, batch_size=None, batch_delay=None, media=None, media_type=None):
+async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=True, batch_size=None, batch_delay=None, media=None, media_type=None, disable_notification=False, broadcast_id=None):
     """
     Отправка рассылки пользователям
     
@@ -45,17 +65,25 @@ async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=
         target_filter (dict, optional): Фильтр для выбора целевых пользователей
         save_to_db (bool, optional): Сохранять ли рассылку в базу данных
         batch_size (int, optional): Размер пакета сообщений для отправки (по умолчанию 25)
-        batch_delay (int, optional): Задержка между пакетами в секундах (по умолчанию 3)
+        batch_delay (int, optional): Задержка между пакетами в секундах (по умолчанию без задержки)
         media (str, optional): Путь или file_id медиа-файла для отправки вместе с сообщением
         media_type (str, optional): Тип медиа: "photo", "video", "animation" (gif)
+        disable_notification (bool, optional): Отправить сообщения без звукового уведомления
+        broadcast_id (ObjectId, optional): ID уже существующей записи о рассылке (запланированная рассылка).
+            Прогресс и итоговая статистика записываются в нее вместо создания новой записи
         
     Returns:
         dict: Статистика по отправке сообщений
     """
     # Настройки для безопасной отправки сообщений
-    SAFE_MESSAGE_DELAY = 0.4  # 400 мс между сообщениями (макс. 30 сообщений в сек. по лимитам TG)
-    DEFAULT_BATCH_SIZE = 25   # Количество сообщений в одном пакете
-    DEFAULT_BATCH_DELAY = 3   # Задержка между пакетами в секундах
+    MAX_CONCURRENT_SENDS = 25  # Количество воркеров, одновременно отправляющих запросы к Telegram API
+    MAX_RETRY_AFTER_ATTEMPTS = 2  # Количество повторов после ответа RetryAfter
+    DEFAULT_BATCH_SIZE = 25    # Количество сообщений в одном пакете
+    DEFAULT_BATCH_DELAY = 0    # Задержка между пакетами в секундах (скорость ограничивает BOT_LIMITER)
+    QUEUE_SIZE = 2 * MAX_CONCURRENT_SENDS  # Максимум пользователей, ожидающих отправки в памяти
+    CURSOR_BATCH_SIZE = 500    # Количество документов, получаемых из MongoDB за один запрос
+    PROGRESS_FLUSH_INTERVAL = 5  # Интервал сохранения прогресса в базу данных (секунды)
+    PROGRESS_LOG_EVERY = 1000  # Периодичность сводного лога о прогрессе (сообщений)
 
     # Используем значения по умолчанию, если не указаны
     batch_size = batch_size or DEFAULT_BATCH_SIZE
@@ -64,35 +92,37 @@ async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=
     # Проверяем, что бот правильно передан
     logging.info(f"Экземпляр бота для рассылки: {bot}")
     
-    # Получаем всех пользователей, независимо от статуса
-    if target_filter:
-        # Всегда добавляем фильтр по статусу "active", если он не указан явно
-        combined_filter = target_filter.copy() if isinstance(target_filter, dict) else {}
-        if "status" not in combined_filter:
-            combined_filter["status"] = "active"
-        
-        users = await get_users_by_filter(combined_filter)
-        logging.info(f"Получены пользователи по фильтру: {combined_filter}, найдено {len(users)} пользователей")
-    else:
-        # По умолчанию получаем только активных пользователей
-        users = await get_all_users(status="active")
-        logging.info(f"Получены все активные пользователи, найдено {len(users)} пользователей")
+    # Всегда добавляем фильтр по статусу "active", если он не указан явно
+    combined_filter = target_filter.copy() if isinstance(target_filter, dict) else {}
+    if "status" not in combined_filter:
+        combined_filter["status"] = "active"
     
-    if not users:
+    # Считаем получателей на стороне MongoDB, сами документы читаются потоково при отправке
+    total_users = await count_users_by_filter(combined_filter)
+    logging.info(f"Получены пользователи по фильтру: {combined_filter}, найдено {total_users} пользователей")
+    
+    broadcasts = get_db()[BROADCASTS_COLLECTION]
+    # Время начала рассылки: используется для записи в базу и расчета времени завершения
+    started_at = datetime.utcnow()
+    
+    if not total_users:
         logging.warning("Не найдено пользователей для рассылки!")
+        if broadcast_id:
+            await broadcasts.update_one(
+                {"_id": broadcast_id},
+                {"$set": {"status": "completed", "completed_at": started_at, "sent_count": 0, "failed_count": 0}}
+            )
         return {"total": 0, "sent": 0, "failed": 0}
     
-    logging.info(f"Начинаем рассылку: найдено {len(users)} пользователей для отправки")
+    logging.info(f"Начинаем рассылку: найдено {total_users} пользователей для отправки")
     
-    # Создаем запись о рассылке в базе данных
-    broadcast_id = None
-    db = get_db()
-    if save_to_db:
+    # Создаем запись о рассылке в базе данных (если не передана существующая)
+    if save_to_db and not broadcast_id:
         broadcast_data = {
             "message_text": message_text,
             "target_filter": target_filter,
-            "total_users": len(users),
-            "created_at": datetime.utcnow(),
+            "total_users": total_users,
+            "created_at": started_at,
             "status": "in_progress",
             "sent_count": 0,
             "failed_count": 0
@@ -103,23 +133,24 @@ async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=
             broadcast_data["media"] = media
             broadcast_data["media_type"] = media_type
             
-        result = await db[BROADCASTS_COLLECTION].insert_one(broadcast_data)
+        result = await broadcasts.insert_one(broadcast_data)
         broadcast_id = result.inserted_id
         logging.info(f"Создана запись о рассылке в базе данных, ID: {broadcast_id}")
     
     # Счетчики для статистики
     sent_count = 0
     failed_count = 0
-    errors_by_type = {}
+    errors_by_type = Counter()
+    # Пользователи, недоступные навсегда (тип ошибки -> список ID)
+    dead_users = {}
     
-    # Разделяем пользователей на пакеты для отправки
-    total_users = len(users)
+    # Пакеты используются для логирования прогресса и паузы между ними
     total_batches = math.ceil(total_users / batch_size)
     logging.info(f"Рассылка будет отправлена в {total_batches} пакетах по {batch_size} сообщений")
     
     # Расчет примерного времени завершения
-    estimated_time_seconds = total_batches * batch_delay + total_users * SAFE_MESSAGE_DELAY
-    estimated_completion_time = datetime.utcnow() + timedelta(seconds=estimated_time_seconds)
+    estimated_time_seconds = (total_batches - 1) * batch_delay + total_users / MESSAGES_PER_SECOND
+    estimated_completion_time = started_at + timedelta(seconds=estimated_time_seconds)
     logging.info(f"Примерное время завершения рассылки: {estimated_completion_time.strftime('%Y-%m-%d %H:%M:%S')}")
     
     # Информация о медиа-контенте
@@ -127,189 +158,215 @@ async def send_broadcast(bot: Bot, message_text, target_filter=None, save_to_db=
     if has_media:
         logging.info(f"Рассылка содержит медиа-контент типа: {media_type}, значение: {media}")
     
-    for batch_index in range(total_batches):
-        start_idx = batch_index * batch_size
-        end_idx = min(start_idx + batch_size, total_users)
-        current_batch = users[start_idx:end_idx]
-        
-        logging.info(f"Отправка пакета {batch_index + 1}/{total_batches} ({len(current_batch)} пользователей)")
+    # Число воркеров ограничивает количество одновременных запросов,
+    # а общий token bucket (BOT_LIMITER) — скорость отправки
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    loop = asyncio.get_running_loop()
+    
+    # Метод API и параметры запроса одинаковы для всех получателей, формируем их один раз
+    # (медиа передается по file_id, поэтому файл не загружается повторно)
+    if has_media and media_type in _MEDIA_SENDERS:
+        api_method, media_key = _MEDIA_SENDERS[media_type]
+        base_payload = {media_key: media, "caption": message_text}
+    else:
+        if has_media:
+            # Если неизвестный тип медиа, отправляем только текст
+            logging.warning(f"Неизвестный тип медиа: {media_type}, отправляем только текст")
+        # Отправка только текста
+        api_method, base_payload = api.Methods.SEND_MESSAGE, {"text": message_text}
+    
+    if disable_notification:
+        base_payload["disable_notification"] = True
+    
+    async def _deliver(user_id):
+        # Запрос выполняется напрямую: готовый payload дополняется только chat_id,
+        # а ответ не преобразуется в объект Message, так как для рассылки он не нужен.
+        # Ошибки API (BotBlocked, RetryAfter и т.д.) aiogram выбрасывает так же, как в send_message
+        await bot.request(api_method, {**base_payload, "chat_id": user_id})
+    
+    async def _send_one(user):
+        """Отправка одному пользователю. Возвращает (успех, тип ошибки)."""
+        global _pause_until
+        user_id = user.get("user_id")
+        if not user_id:
+            logging.warning(f"Пользователь без ID: {user}")
+            return False, None
         
-        for user in current_batch:
-            user_id = user.get("user_id")
-            if not user_id:
-                logging.warning(f"Пользователь без ID: {user}")
-                failed_count += 1
-                continue
-                
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+            # Если Telegram потребовал паузу, ждут все воркеры, а не только получивший RetryAfter
+            delay = _pause_until - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
             try:
-                logging.info(f"Отправка сообщения пользователю {user_id}")
-                
-                # В зависимости от наличия и типа медиа-контента выбираем метод отправки
-                if not has_media:
-                    # Отправка только текста
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message_text
-                    )
-                else:
-                    # Отправка сообщения с медиа-контентом
-                    if media_type == "photo":
-                        await bot.send_photo(
-                            chat_id=user_id,
-                            photo=media,
-                            caption=message_text
-                        )
-                    elif media_type == "video":
-                        await bot.send_video(
-                            chat_id=user_id,
-                            video=media,
-                            caption=message_text
-                        )
-                    elif media_type == "animation":
-                        await bot.send_animation(
-                            chat_id=user_id,
-                            animation=media,
-                            caption=message_text
-                        )
-                    else:
-                        # Если неизвестный тип медиа, отправляем только текст
-                        logging.warning(f"Неизвестный тип медиа: {media_type}, отправляем только текст")
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=message_text
-                        )
-                
-                sent_count += 1
-                logging.info(f"Сообщение успешно отправлено пользователю {user_id}")
-                
-                # Обновляем статистику в базе данных
-                if save_to_db and broadcast_id:
-                    await db[BROADCASTS_COLLECTION].update_one(
-                        {"_id": broadcast_id},
-                        {"$inc": {"sent_count": 1}}
-                    )
-                
-                # Увеличенная задержка между отправками для соблюдения лимитов API
-                await asyncio.sleep(SAFE_MESSAGE_DELAY)
+                async with BOT_LIMITER:
+                    await _deliver(user_id)
+                # Лог на каждое сообщение нужен только при отладке: на больших рассылках он тормозит event loop
+                if debug_enabled:
+                    logging.debug("Сообщение успешно отправлено пользователю %s", user_id)
+                return True, None
             
             except RetryAfter as e:
-                # Обработка ошибки превышения лимитов
-                retry_after = e.timeout
-                logging.warning(f"Превышен лимит запросов к API, ожидание {retry_after} секунд")
-                
-                # Увеличиваем задержку на будущее
-                SAFE_MESSAGE_DELAY = max(SAFE_MESSAGE_DELAY, retry_after / batch_size + 0.1)
-                
-                # Ожидаем указанное время и повторяем попытку
-                await asyncio.sleep(retry_after)
-                try:
-                    # Повторяем отправку
-                    if not has_media:
-                        await bot.send_message(chat_id=user_id, text=message_text)
-                    else:
-                        if media_type == "photo":
-                            await bot.send_photo(chat_id=user_id, photo=media, caption=message_text)
-                        elif media_type == "video":
-                            await bot.send_video(chat_id=user_id, video=media, caption=message_text)
-                        elif media_type == "animation":
-                            await bot.send_animation(chat_id=user_id, animation=media, caption=message_text)
-                        else:
-                            await bot.send_message(chat_id=user_id, text=message_text)
-                            
-                    sent_count += 1
-                    
-                    if save_to_db and broadcast_id:
-                        await db[BROADCASTS_COLLECTION].update_one(
-                            {"_id": broadcast_id},
-                            {"$inc": {"sent_count": 1}}
-                        )
-                except Exception as e2:
-                    failed_count += 1
-                    logging.error(f"Повторная ошибка при отправке сообщения пользователю {user_id}: {e2}")
-                    
-                    if save_to_db and broadcast_id:
-                        await db[BROADCASTS_COLLECTION].update_one(
-                            {"_id": broadcast_id},
-                            {"$inc": {"failed_count": 1}}
-                        )
+                # Обработка ошибки превышения лимитов: ожидаем указанное время и повторяем попытку
+                if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    logging.error("Превышено число повторных попыток отправки пользователю %s: %s", user_id, e)
+                    return False, "RetryAfter"
+                logging.warning(f"Превышен лимит запросов к API, ожидание {e.timeout} секунд")
+                _pause_until = max(_pause_until, loop.time() + e.timeout)
             
             except (BotBlocked, UserDeactivated, ChatNotFound, Unauthorized, CantInitiateConversation) as e:
-                # Специфические ошибки Telegram API
-                error_type = type(e).__name__
-                if error_type not in errors_by_type:
-                    errors_by_type[error_type] = 0
-                errors_by_type[error_type] += 1
-                
-                failed_count += 1
-                logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-                
-                # Обновляем статистику в базе данных
-                if save_to_db and broadcast_id:
-                    await db[BROADCASTS_COLLECTION].update_one(
-                        {"_id": broadcast_id},
-                        {"$inc": {"failed_count": 1}}
-                    )
+                # Недоступные пользователи — ожидаемая ситуация: они учитываются в errors_by_type
+                # и помечаются после рассылки, поэтому отдельная запись в лог нужна только при отладке
+                if debug_enabled:
+                    logging.debug("Пользователь %s недоступен: %s", user_id, e)
+                return False, type(e).__name__
             
             except TelegramAPIError as e:
                 # Другие ошибки API Telegram
-                error_type = "TelegramAPIError"
-                if error_type not in errors_by_type:
-                    errors_by_type[error_type] = 0
-                errors_by_type[error_type] += 1
-                
-                failed_count += 1
-                logging.error(f"Ошибка API Telegram при отправке пользователю {user_id}: {e}")
-                
-                if save_to_db and broadcast_id:
-                    await db[BROADCASTS_COLLECTION].update_one(
-                        {"_id": broadcast_id},
-                        {"$inc": {"failed_count": 1}}
-                    )
-                
+                logging.error("Ошибка API Telegram при отправке пользователю %s: %s", user_id, e)
+            
                 # Делаем небольшую паузу при ошибках API
                 await asyncio.sleep(1)
+                return False, "TelegramAPIError"
             
             except Exception as e:
                 # Общие ошибки
-                error_type = type(e).__name__
-                if error_type not in errors_by_type:
-                    errors_by_type[error_type] = 0
-                errors_by_type[error_type] += 1
-                
+                logging.error("Ошибка при отправке сообщения пользователю %s: %s", user_id, e)
+                return False, type(e).__name__
+    
+    # Сигнал остановки сохранения прогресса. Задачу не отменяем: motor выполняет запрос
+    # в отдельном потоке, и отмена не остановила бы уже начатую запись устаревших счетчиков
+    stop_progress = asyncio.Event()
+    
+    async def _progress_flusher():
+        """Периодически сохраняет текущие счетчики, чтобы был виден прогресс длинной рассылки."""
+        saved = (0, 0)
+        while True:
+            try:
+                await asyncio.wait_for(stop_progress.wait(), timeout=PROGRESS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if stop_progress.is_set():
+                return
+            current = (sent_count, failed_count)
+            # Не пишем в базу, если с прошлого сохранения ничего не изменилось (например, во время паузы RetryAfter)
+            if current == saved:
+                continue
+            try:
+                # Разбивка ошибок меняется только вместе с failed_count, сохраняем ее тем же запросом
+                await broadcasts.update_one(
+                    {"_id": broadcast_id},
+                    {"$set": {
+                        "sent_count": current[0],
+                        "failed_count": current[1],
+                        "errors_by_type": dict(errors_by_type)
+                    }}
+                )
+                saved = current
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении прогресса рассылки {broadcast_id}: {e}")
+    
+    progress_task = None
+    if broadcast_id:
+        progress_task = asyncio.create_task(_progress_flusher())
+    
+    # Ограниченная очередь: в памяти находятся только пользователи, ожидающие отправки
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    
+    async def _worker():
+        nonlocal sent_count, failed_count
+        while True:
+            user = await queue.get()
+            try:
+                is_sent, error_type = await _send_one(user)
+                if is_sent:
+                    sent_count += 1
+                    continue
                 failed_count += 1
-                logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-                
-                # Обновляем статистику в базе данных
-                if save_to_db and broadcast_id:
-                    await db[BROADCASTS_COLLECTION].update_one(
-                        {"_id": broadcast_id},
-                        {"$inc": {"failed_count": 1}}
+                if error_type:
+                    errors_by_type[error_type] += 1
+                if error_type in DEAD_USER_ERRORS:
+                    dead_users.setdefault(error_type, []).append(user["user_id"])
+            finally:
+                queue.task_done()
+                # Сводный прогресс вместо лога на каждое сообщение
+                processed_count = sent_count + failed_count
+                if processed_count % PROGRESS_LOG_EVERY == 0:
+                    logging.info(
+                        "Прогресс рассылки: обработано %d/%d, отправлено %d, ошибок %d",
+                        processed_count, total_users, sent_count, failed_count
                     )
+    
+    workers = [asyncio.create_task(_worker()) for _ in range(MAX_CONCURRENT_SENDS)]
+    
+    try:
+        # Читаем из базы только user_id, не загружая всех пользователей в память
+        cursor = get_users_cursor(combined_filter, projection={"user_id": 1, "_id": 0}, batch_size=CURSOR_BATCH_SIZE)
+        queued_count = 0
+        # Индекс users.user_id уникальный, поэтому курсор не возвращает одного пользователя дважды
+        async for user in cursor:
+            await queue.put(user)
+            queued_count += 1
+            
+            if queued_count % batch_size == 0:
+                batch_index = queued_count // batch_size
+                if debug_enabled:
+                    logging.debug("Поставлен в очередь пакет %d/%d", batch_index, total_batches)
+                # Задержка между пакетами отправки
+                if batch_delay and batch_index < total_batches:
+                    await asyncio.sleep(batch_delay)
         
-        # Задержка между пакетами отправки
-        if batch_index < total_batches - 1:  # Не делаем задержку после последнего пакета
-            logging.info(f"Завершен пакет {batch_index + 1}/{total_batches}. Ожидание {batch_delay} секунд перед следующим пакетом")
-            await asyncio.sleep(batch_delay)
-    
-    # Обновляем статус рассылки в базе данных
-    if save_to_db and broadcast_id:
-        await db[BROADCASTS_COLLECTION].update_one(
+        # Дожидаемся отправки всех сообщений из очереди
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        if progress_task:
+            # Дожидаемся завершения начатой записи прогресса, чтобы она не перезаписала итоговую статистику
+            stop_progress.set()
+            await progress_task
+    
+    async def _mark_dead_users():
+        # Помечаем недоступных пользователей, чтобы следующие рассылки их пропускали
+        if not dead_users:
+            return
+        try:
+            await mark_users_blocked(dead_users)
+        except Exception as e:
+            logging.error(f"Ошибка при пометке недоступных пользователей: {e}")
+    
+    async def _save_final_stats():
+        # Сохраняем итоговую статистику и статус рассылки одним запросом
+        if not broadcast_id:
+            return
+        await broadcasts.update_one(
             {"_id": broadcast_id},
-            {"$set": {"status": "completed", "completed_at": datetime.utcnow()}}
+            {"$set": {
+                "status": "completed",
+                "completed_at": datetime.utcnow(),
+                "sent_count": sent_count,
+                "failed_count": failed_count,
+                "errors_by_type": dict(errors_by_type)
+            }}
         )
     
+    # Записи в коллекции пользователей и рассылок независимы, выполняем их параллельно
+    await asyncio.gather(_mark_dead_users(), _save_final_stats())
+    
     # Возвращаем статистику
     stats = {
-        "total": len(users),
+        "total": total_users,
         "sent": sent_count,
         "failed": failed_count,
-        "errors": errors_by_type if errors_by_type else None
+        "errors": dict(errors_by_type) if errors_by_type else None
     }
     
-    logging.info(f"Рассылка завершена. Статистика: {stats}")
+    logging.info(
+        "Рассылка %s завершена: отправлено=%d, ошибок=%d, по типам=%s",
+        broadcast_id, sent_count, failed_count, dict(errors_by_type)
+    )
     return stats
 
-async def schedule_broadcast(bot: Bot, message_text, schedule_time, target_filter=None, media=None, media_type=None):
+async def schedule_broadcast(bot: Bot, message_text, schedule_time, target_filter=None, media=None, media_type=None, disable_notification=False):
     """
     Планирование отложенной рассылки
     
@@ -320,26 +377,23 @@ async def schedule_broadcast(bot: Bot, message_text, schedule_time, target_filte
         target_filter (dict, optional): Фильтр для выбора целевых пользователей
         media (str, optional): Путь или file_id медиа-файла для отправки вместе с сообщением
         media_type (str, optional): Тип медиа: "photo", "video", "animation" (gif)
+        disable_notification (bool, optional): Отправить сообщения без звукового уведомления
         
     Returns:
         str: ID запланированной рассылки
     """
-    db = get_db()
+    broadcasts = get_db()[BROADCASTS_COLLECTION]
     
     # Проверяем, имеет ли время часовой пояс
     if schedule_time.tzinfo is None:
         # Если время без часового пояса, предполагаем, что это локальное время
         # и приводим его к UTC для хранения в базе данных
-        import pytz
         
-        # Получаем локальный часовой пояс
-        local_tz = pytz.timezone('Europe/Moscow')  # Можно заменить на нужный часовой пояс
-        
-        # Локализуем время
-        localized_time = local_tz.localize(schedule_time)
+        # Локализуем время (zoneinfo не требует localize, достаточно указать tzinfo)
+        localized_time = schedule_time.replace(tzinfo=MOSCOW_TZ)
         
         # Конвертируем в UTC
-        utc_time = localized_time.astimezone(pytz.UTC)
+        utc_time = localized_time.astimezone(timezone.utc)
         
         # Используем UTC время для сохранения (без информации о часовом поясе)
         schedule_time = utc_time.replace(tzinfo=None)
@@ -350,9 +404,10 @@ async def schedule_broadcast(bot: Bot, message_text, schedule_time, target_filte
     combined_filter = target_filter.copy() if isinstance(target_filter, dict) else {}
     if "status" not in combined_filter:
         combined_filter["status"] = "active"
-        
-    users = await get_users_by_filter(combined_filter)
-    total_users = len(users)
+    
+    # Количество сохраняется в запись рассылки, поэтому считаем без кеша
+    # (кешированное значение используется только на экранах подтверждения)
+    total_users = await count_users_by_filter(combined_filter)
     
     logging.info(f"Запланированная рассылка будет отправлена {total_users} пользователям с фильтром {combined_filter}")
     
@@ -374,8 +429,16 @@ async def schedule_broadcast(bot: Bot, message_text, schedule_time, target_filte
         broadcast_data["media_type"] = media_type
         logging.info(f"Запланирована рассылка с медиа-контентом типа: {media_type}")
     
-    result = await db[BROADCASTS_COLLECTION].insert_one(broadcast_data)
+    if disable_notification:
+        broadcast_data["disable_notification"] = True
+    
+    result = await broadcasts.insert_one(broadcast_data)
     broadcast_id = result.inserted_id
     
     logging.info(f"Рассылка запланирована на {schedule_time.isoformat()} UTC, ID: {broadcast_id}")
+    
+    # Импортируем здесь, чтобы избежать цикличного импорта (планировщик использует send_broadcast)
+    from bot.utils.scheduler import schedule_broadcast_job
+    schedule_broadcast_job(bot, broadcast_id, schedule_time)
+    
     return str(broadcast_id)
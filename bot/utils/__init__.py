@@ -3,5 +3,6 @@
 """
 
 from bot.utils.logging_setup import setup_logging, clean_old_logs
-from bot.utils.scheduler import setup_scheduler, check_scheduled_broadcasts, migrate_old_broadcasts, create_broadcast_check_job
-from bot.utils.send_email import send_consultation_email 
\ No newline at end of file
+from bot.utils.scheduler import setup_scheduler, migrate_old_broadcasts, schedule_broadcast_job, restore_scheduled_broadcasts
+from bot.utils.send_email import send_consultation_email
+from bot.utils.activity_buffer import mark_active, flush_activity
@@ -0,0 +1,58 @@
+"""
+Буфер времени последнего взаимодействия пользователей.
+Вместо записи в MongoDB на каждое сообщение время сохраняется в памяти
+и периодически сбрасывается в базу одним bulk-запросом.
+"""
+
+import logging
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from bot.database.db import get_db
+from bot.config.config import USERS_COLLECTION
+
+# user_id -> время последнего взаимодействия (UNIX timestamp).
+# В базу время записывается как datetime, преобразование выполняется только при сбросе
+_pending: dict[int, float] = {}
+
+
+def mark_active(user_id: int) -> None:
+    """Отмечает взаимодействие пользователя (без обращения к базе данных)."""
+    _pending[user_id] = time.time()
+
+
+async def flush_activity() -> int:
+    """
+    Сохраняет накопленные отметки активности в базу данных
+
+    Returns:
+        int: Количество пользователей, для которых сохранено время взаимодействия
+    """
+    global _pending
+    if not _pending:
+        return 0
+
+    # Подменяем словарь целиком, чтобы отметки, пришедшие во время записи, не потерялись
+    snapshot, _pending = _pending, {}
+    # $max вместо $set: /start записывает время взаимодействия в базу сразу,
+    # и более старая отметка из буфера не должна его перезаписать
+    operations = []
+    for user_id, timestamp in snapshot.items():
+        interaction_time = datetime.utcfromtimestamp(timestamp)
+        operations.append(UpdateOne(
+            {"user_id": user_id},
+            {"$max": {"last_interaction": interaction_time, "updated_at": interaction_time}}
+        ))
+    try:
+        await get_db()[USERS_COLLECTION].bulk_write(operations, ordered=False)
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении активности пользователей: {e}")
+        # Возвращаем отметки в буфер, не перезаписывая более свежие
+        for user_id, timestamp in snapshot.items():
+            _pending.setdefault(user_id, timestamp)
+        return 0
+
+    logging.debug(f"Сохранена активность {len(operations)} пользователей")
+    return len(operations)
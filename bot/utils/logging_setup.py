@@ -3,11 +3,16 @@
 """
 
 import os
+import atexit
 import logging
+import queue
 import time
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
 
+# Поток, записывающий логи в файлы и консоль (хранится, чтобы его можно было остановить)
+_log_listener = None
+
 def setup_logging(log_dir="logs", log_level=logging.INFO, 
                  max_size_mb=5, backup_count=5, 
                  enable_time_rotation=True, rotation_interval='midnight'):
@@ -76,12 +81,25 @@ def setup_logging(log_dir="logs", log_level=logging.INFO,
     console_handler.setFormatter(log_format)
     console_handler.setLevel(log_level)
     
+    # Запись в файлы (включая ротацию) выполняется в отдельном потоке,
+    # корневой логгер только кладет записи в очередь и не блокирует event loop
+    global _log_listener
+    log_queue = queue.Queue(-1)
+    _log_listener = QueueListener(
+        log_queue,
+        file_handler,
+        error_file_handler,
+        console_handler,
+        respect_handler_level=True
+    )
+    _log_listener.start()
+    # При завершении процесса дописываем оставшиеся в очереди записи
+    atexit.register(_log_listener.stop)
+    
     # Настраиваем корневой логгер
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(error_file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(QueueHandler(log_queue))
     
     # Отключаем ненужные логи от внешних библиотек
     logging.getLogger('aiogram').setLevel(logging.WARNING)
@@ -112,28 +130,28 @@ def clean_old_logs(log_dir="logs", days_to_keep=30):
     
     count_removed = 0
     
-    for filename in os.listdir(log_dir):
-        # Пропускаем файл keep
-        if filename == 'keep':
-            continue
-            
-        # Пропускаем текущие файлы логов без даты
-        if filename in ['bot.log', 'errors.log']:
-            continue
-            
-        file_path = os.path.join(log_dir, filename)
-        
-        # Проверяем, что это файл (не директория)
-        if os.path.isfile(file_path):
-            file_age = current_time - os.path.getmtime(file_path)
+    # scandir возвращает тип файла вместе с именем, stat кешируется в DirEntry
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            # Пропускаем файл keep
+            if entry.name == 'keep':
+                continue
+                
+            # Пропускаем текущие файлы логов без даты
+            if entry.name in ['bot.log', 'errors.log']:
+                continue
             
-            # Если файл старше максимального возраста, удаляем его
-            if file_age > max_age:
-                try:
-                    os.remove(file_path)
-                    count_removed += 1
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении старого лога {file_path}: {e}")
+            # Проверяем, что это файл (не директория)
+            if entry.is_file(follow_symlinks=False):
+                file_age = current_time - entry.stat().st_mtime
+                
+                # Если файл старше максимального возраста, удаляем его
+                if file_age > max_age:
+                    try:
+                        os.remove(entry.path)
+                        count_removed += 1
+                    except Exception as e:
+                        logging.error(f"Ошибка при удалении старого лога {entry.path}: {e}")
     
     if count_removed > 0:
         logging.info(f"Удалено {count_removed} устаревших файлов логов (старше {days_to_keep} дней)") 
\ No newline at end of file
@@ -1,7 +1,7 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 
-def get_main_menu():
+def _build_main_menu():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(KeyboardButton("Получить консультацию"))
 
@@ -9,4 +9,12 @@ def get_main_menu():
     keyboard.add(KeyboardButton("Интернет-магазин"))
     keyboard.add(KeyboardButton("Конфигуратор"))
 
-    return keyboard
\ No newline at end of file
+    return keyboard
+
+
+# Меню статично, поэтому собирается один раз при импорте модуля
+_MAIN_MENU = _build_main_menu()
+
+
+def get_main_menu():
+    return _MAIN_MENU
@@ -2,23 +2,32 @@
 Модуль для планирования отложенных задач
 """
 
-import logging
 import asyncio
-from datetime import datetime
+import logging
+import random
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from bson import ObjectId
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
 from pytz import utc
-import pytz
 
 from bot.database.db import get_db
-from bot.config.config import BROADCASTS_COLLECTION
+from bot.config.config import BROADCASTS_COLLECTION, BROADCAST_CONCURRENCY, MIGRATIONS_COLLECTION, MOSCOW_TZ
 from bot.services.notifications import send_broadcast
-# Убран импорт clean_old_pending_approvals - функция удалена вместе с join_request_handlers
+
+# Идентификатор миграции времени рассылок в коллекции выполненных миграций
+BROADCASTS_UTC_MIGRATION = "broadcasts_utc"
 
 # Глобальная переменная для хранения планировщика
 _scheduler = None
 
-_background_tasks: set[asyncio.Task] = set()
+# Повторы запуска запланированной рассылки при ошибках базы данных
+MAX_START_ATTEMPTS = 8
+MAX_START_RETRY_DELAY = 300  # секунд
+
+# Запланированные рассылки выполняются параллельно, но не больше BROADCAST_CONCURRENCY сразу:
+# скорость отправки и так ограничена общим лимитером, а каждая рассылка держит воркеров и курсор
+_broadcast_slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
 def setup_scheduler():
     """
@@ -37,33 +46,49 @@ def setup_scheduler():
     
     return _scheduler
 
-# Создаем функцию-обертку для передачи в APScheduler
-def create_broadcast_check_job(bot):
+def schedule_broadcast_job(bot, broadcast_id, run_date, attempt=0):
     """
-    Создает функцию-обертку для проверки запланированных рассылок
+    Регистрирует в планировщике разовую задачу отправки рассылки на указанное время
     
     Args:
         bot: Экземпляр бота
-        
-    Returns:
-        callable: Функция для запуска в планировщике
+        broadcast_id (str): ID рассылки в базе данных
+        run_date (datetime): Время отправки (UTC, без часового пояса)
+        attempt (int, optional): Номер повторной попытки запуска
     """
-    async def job():
-        await check_scheduled_broadcasts(bot)
-    return job
+    scheduler = setup_scheduler()
+    scheduler.add_job(
+        run_scheduled_broadcast,
+        'date',
+        run_date=run_date,
+        args=[bot, str(broadcast_id), attempt],
+        id=f"broadcast_{broadcast_id}",
+        replace_existing=True,
+        misfire_grace_time=None  # Просроченную рассылку (например, после перезапуска) отправляем сразу
+    )
+    logging.info(f"Рассылка ID:{broadcast_id} поставлена в планировщик на {run_date.isoformat()} UTC")
 
 async def migrate_old_broadcasts():
     """
     Миграция старых записей рассылок в формат UTC
+    
+    Выполняется один раз: повторный запуск сдвинул бы время рассылок,
+    уже сохраненных в UTC, поэтому факт выполнения сохраняется в базе
     """
     try:
         db = get_db()
-        local_tz = pytz.timezone('Europe/Moscow')  # Часовой пояс для старых записей
+        migrations = db[MIGRATIONS_COLLECTION]
+        if await migrations.find_one({"_id": BROADCASTS_UTC_MIGRATION}, {"_id": 1}):
+            logging.info("Миграция времени рассылок уже выполнена ранее")
+            return
+        
+        broadcasts = db[BROADCASTS_COLLECTION]
         
         # Находим все запланированные рассылки
-        scheduled_broadcasts = await db[BROADCASTS_COLLECTION].find({
-            "status": "scheduled"
-        }).to_list(length=None)
+        scheduled_broadcasts = await broadcasts.find(
+            {"status": "scheduled"},
+            {"_id": 1, "schedule_time": 1}
+        ).to_list(length=None)
         
         migrated_count = 0
         
@@ -74,16 +99,16 @@ async def migrate_old_broadcasts():
                 if isinstance(schedule_time, datetime) and schedule_time.hour > 14:
                     # Предполагаем, что это локальное время
                     # Локализуем время
-                    localized_time = local_tz.localize(schedule_time.replace(tzinfo=None))
+                    localized_time = schedule_time.replace(tzinfo=MOSCOW_TZ)
                     
                     # Конвертируем в UTC
-                    utc_time = localized_time.astimezone(pytz.UTC)
+                    utc_time = localized_time.astimezone(utc)
                     
                     # Убираем информацию о часовом поясе для совместимости
                     utc_time = utc_time.replace(tzinfo=None)
                     
                     # Обновляем запись в базе данных
-                    await db[BROADCASTS_COLLECTION].update_one(
+                    await broadcasts.update_one(
                         {"_id": broadcast["_id"]},
                         {"$set": {"schedule_time": utc_time}}
                     )
@@ -95,123 +120,131 @@ async def migrate_old_broadcasts():
             logging.info(f"Миграция времени рассылок завершена. Обработано {migrated_count} записей.")
         else:
             logging.info("Миграция времени рассылок: не найдено записей для обновления")
+        
+        await migrations.update_one(
+            {"_id": BROADCASTS_UTC_MIGRATION},
+            {"$set": {"applied_at": datetime.utcnow(), "migrated_count": migrated_count}},
+            upsert=True
+        )
     
     except Exception as e:
         logging.error(f"Ошибка при миграции времени рассылок: {e}")
 
-async def check_scheduled_broadcasts(bot):
+async def restore_scheduled_broadcasts(bot):
     """
-    Проверка и отправка запланированных рассылок
+    Регистрирует в планировщике задачи для всех запланированных рассылок из базы данных.
+    Вызывается один раз при запуске, так как задачи планировщика хранятся только в памяти.
     
     Args:
         bot: Экземпляр бота
     """
     try:
-        db = get_db()
-        now = datetime.utcnow()
-        
-        # Также получаем московское время для информативного логгирования
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        moscow_now = now.replace(tzinfo=pytz.UTC).astimezone(moscow_tz)
-        
-        logging.info(f"Проверка запланированных рассылок в {now.isoformat()} UTC / {moscow_now.strftime('%d.%m.%Y %H:%M:%S')} МСК")
-        
-        # Находим все запланированные рассылки, время которых наступило
-        scheduled_broadcasts = await db[BROADCASTS_COLLECTION].find({
-            "status": "scheduled",
-            "schedule_time": {"$lte": now}
-        }).to_list(length=None)
-        
-        logging.info(f"Найдено {len(scheduled_broadcasts)} запланированных рассылок для отправки")
+        broadcasts = get_db()[BROADCASTS_COLLECTION]
+        cursor = broadcasts.find(
+            {"status": "scheduled"},
+            {"_id": 1, "schedule_time": 1}
+        )
         
-        # Выводим информацию о всех запланированных рассылках для отладки
-        all_scheduled = await db[BROADCASTS_COLLECTION].find({"status": "scheduled"}).to_list(length=None)
-        if all_scheduled:
-            logging.info(f"Всего запланированных рассылок в базе: {len(all_scheduled)}")
-            for bc in all_scheduled:
-                bc_time = bc.get('schedule_time', 'не указано')
-                if isinstance(bc_time, datetime):
-                    # Конвертируем UTC время рассылки в московское для информативности
-                    bc_time_moscow = bc_time.replace(tzinfo=pytz.UTC).astimezone(moscow_tz)
-                    bc_time_str = f"{bc_time} UTC / {bc_time_moscow.strftime('%d.%m.%Y %H:%M:%S')} МСК"
-                else:
-                    bc_time_str = str(bc_time)
-                    
-                target_filter = bc.get('target_filter', {})
-                logging.info(f"Запланированная рассылка ID:{bc['_id']}, время: {bc_time_str}, фильтр: {target_filter}, текущее время: {now} UTC")
+        restored_count = 0
+        async for broadcast in cursor:
+            schedule_time = broadcast.get("schedule_time")
+            if not isinstance(schedule_time, datetime):
+                logging.warning(f"У запланированной рассылки ID:{broadcast['_id']} не указано время отправки")
+                continue
+            
+            schedule_broadcast_job(bot, broadcast["_id"], schedule_time)
+            restored_count += 1
         
-        if not scheduled_broadcasts:
-            return
+        logging.info(f"Восстановлено запланированных рассылок: {restored_count}")
+    
+    except Exception as e:
+        logging.error(f"Ошибка при восстановлении запланированных рассылок: {e}")
 
-        for broadcast in scheduled_broadcasts:
-            # Отмечаем, что рассылка в процессе (до запуска фоновой задачи,
-            # чтобы следующая итерация scheduler не подхватила её повторно)
-            target_filter = broadcast.get("target_filter", {})
-            if isinstance(target_filter, dict) and "status" not in target_filter:
-                target_filter["status"] = "active"
-                await db[BROADCASTS_COLLECTION].update_one(
-                    {"_id": broadcast["_id"]},
-                    {"$set": {"target_filter": target_filter}}
-                )
-
-            await db[BROADCASTS_COLLECTION].update_one(
+async def run_scheduled_broadcast(bot, broadcast_id, attempt=0):
+    """
+    Отправка запланированной рассылки (вызывается планировщиком в назначенное время)
+    
+    Args:
+        bot: Экземпляр бота
+        broadcast_id (str): ID рассылки в базе данных
+        attempt (int, optional): Номер повторной попытки запуска
+    """
+    if not ObjectId.is_valid(broadcast_id):
+        logging.error(f"Некорректный ID запланированной рассылки: {broadcast_id}")
+        return
+    
+    broadcasts = get_db()[BROADCASTS_COLLECTION]
+    try:
+        # Атомарно переводим рассылку в статус in_progress: если она уже отправляется
+        # или была отменена, документ не найдется и повторной отправки не будет
+        broadcast = await broadcasts.find_one_and_update(
+            {"_id": ObjectId(broadcast_id), "status": "scheduled"},
+            {"$set": {"status": "in_progress"}},
+            projection={"message_text": 1, "target_filter": 1, "media": 1, "media_type": 1, "disable_notification": 1}
+        )
+    except (ConnectionFailure, ExecutionTimeout) as e:
+        # Повторяем только захват рассылки и только при временной недоступности базы:
+        # после успешного захвата статус уже in_progress и повторный запуск ее не найдет
+        logging.error(f"Ошибка при запуске запланированной рассылки ID:{broadcast_id}: {e}")
+        if attempt + 1 < MAX_START_ATTEMPTS:
+            # Экспоненциальная задержка со случайной добавкой, чтобы не нагружать недоступную базу
+            delay = min(MAX_START_RETRY_DELAY, 2 ** attempt) + random.uniform(0, 1)
+            logging.info(f"Повторный запуск рассылки ID:{broadcast_id} через {delay:.1f} секунд")
+            schedule_broadcast_job(bot, broadcast_id, datetime.utcnow() + timedelta(seconds=delay), attempt + 1)
+        return
+    except Exception as e:
+        logging.error(f"Ошибка при запуске запланированной рассылки ID:{broadcast_id}: {e}")
+        return
+    
+    if not broadcast:
+        logging.warning(f"Рассылка ID:{broadcast_id} не найдена или уже не в статусе scheduled")
+        return
+    
+    target_filter = broadcast.get("target_filter", {})
+    if isinstance(target_filter, dict) and "status" not in target_filter:
+        # Старые записи сохранялись без фильтра по статусу
+        target_filter["status"] = "active"
+        try:
+            await broadcasts.update_one(
                 {"_id": broadcast["_id"]},
-                {"$set": {"status": "in_progress"}}
+                {"$set": {"target_filter": target_filter}}
             )
-
-            task = asyncio.create_task(_execute_broadcast(bot, broadcast, target_filter))
-            _background_tasks.add(task)
-            task.add_done_callback(_background_tasks.discard)
+        except Exception as e:
+            # Рассылка уже захвачена: отправляем ее с фильтром из памяти
+            logging.error(f"Не удалось сохранить фильтр рассылки ID:{broadcast_id}: {e}")
     
-    except Exception as e:
-        logging.error(f"Ошибка при проверке запланированных рассылок: {e}")
+    await _execute_broadcast(bot, broadcast, target_filter)
 
 
 async def _execute_broadcast(bot, broadcast: dict, target_filter: dict) -> None:
     """Фоновая задача: отправка одной запланированной рассылки."""
-    db = get_db()
+    broadcasts = get_db()[BROADCASTS_COLLECTION]
     broadcast_id = str(broadcast["_id"])
     try:
-        total_users = broadcast.get("total_users", 0)
-        batch_size = 25
-        batch_delay = 3
-
-        if total_users > 5000:
-            batch_size = 100
-            batch_delay = 10
-        elif total_users > 1000:
-            batch_size = 50
-            batch_delay = 5
-
         media = broadcast.get("media")
         media_type = broadcast.get("media_type")
 
-        logging.info(f"Фоновая отправка рассылки ID:{broadcast_id}")
-        stats = await send_broadcast(
-            bot=bot,
-            message_text=broadcast["message_text"],
-            target_filter=target_filter,
-            save_to_db=False,
-            batch_size=batch_size,
-            batch_delay=batch_delay,
-            media=media,
-            media_type=media_type,
-        )
+        if _broadcast_slots.locked():
+            logging.info(f"Рассылка ID:{broadcast_id} ожидает завершения других рассылок")
+        async with _broadcast_slots:
+            logging.info(f"Фоновая отправка рассылки ID:{broadcast_id}")
+            stats = await send_broadcast(
+                bot=bot,
+                message_text=broadcast["message_text"],
+                target_filter=target_filter,
+                save_to_db=False,
+                media=media,
+                media_type=media_type,
+                disable_notification=broadcast.get("disable_notification", False),
+                # Прогресс и итоговый статус записываются в запись запланированной рассылки
+                broadcast_id=broadcast["_id"],
+            )
 
-        await db[BROADCASTS_COLLECTION].update_one(
-            {"_id": broadcast["_id"]},
-            {"$set": {
-                "status": "completed",
-                "completed_at": datetime.utcnow(),
-                "sent_count": stats.get("sent", 0),
-                "failed_count": stats.get("failed", 0),
-            }},
-        )
         logging.info(f"Рассылка ID:{broadcast_id} завершена. Отправлено: {stats.get('sent', 0)}, ошибок: {stats.get('failed', 0)}")
 
     except Exception as e:
         logging.error(f"Ошибка при отправке рассылки ID:{broadcast_id}: {e}")
-        await db[BROADCASTS_COLLECTION].update_one(
+        await broadcasts.update_one(
             {"_id": broadcast["_id"]},
             {"$set": {"status": "error", "error": str(e)}},
         )
\ No newline at end of file
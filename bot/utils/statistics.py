@@ -2,171 +2,224 @@
 Модуль для сбора и экспорта статистики
 """
 
+import asyncio
+import json
 import logging
+from collections import Counter
 from datetime import datetime
 import pandas as pd
 import io
-import asyncio
+import xlsxwriter
 from aiogram import types
-from bot.database import get_all_users, get_users_by_filter
+from bot.database import get_users_cursor
 from bot.database.db import get_db
 from bot.config.config import BROADCASTS_COLLECTION
 
-async def generate_users_statistics_excel():
+# Поля пользователя, которые попадают в выгрузку (остальные из базы не загружаются)
+USER_EXPORT_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "first_name": 1,
+    "last_name": 1,
+    "username": 1,
+    "phone": 1,
+    "created_at": 1,
+    "activated_at": 1,
+    "deactivated_at": 1,
+    "source": 1,
+    "status": 1,
+    "city": 1,
+}
+
+# Количество пользователей, получаемых курсором за один запрос к серверу
+USERS_BATCH_SIZE = 2000
+
+# Поле пользователя -> заголовок столбца в выгрузке (в порядке столбцов)
+USER_EXPORT_COLUMNS = {
+    "user_id": 'ID пользователя',
+    "first_name": 'Имя',
+    "last_name": 'Фамилия',
+    "username": 'Юзернейм',
+    "phone": 'Телефон',
+    "created_at": 'Дата подписки',
+    "activated_at": 'Дата активации',
+    "deactivated_at": 'Дата отписки',
+    "source": 'Источник',
+    "status": 'Статус',
+    "city": 'Город',
+}
+
+# Столбцы выгрузки активных пользователей
+ACTIVE_USER_EXPORT_COLUMNS = {
+    field: title for field, title in USER_EXPORT_COLUMNS.items()
+    if field not in ("deactivated_at", "status")
+}
+
+DATE_FIELDS = ("created_at", "activated_at", "deactivated_at")
+DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+
+# Ширина столбцов выгрузки (для остальных столбцов используется 15).
+# Ширина не рассчитывается по содержимому, чтобы не обходить большие таблицы лишний раз
+COLUMN_WIDTHS = {
+    'Имя': 20,
+    'Фамилия': 20,
+    'Юзернейм': 20,
+    'Источник': 20,
+    'Статус': 20,
+    'Город': 20,
+    'Дата подписки': 25,
+    'Дата активации': 25,
+    'Дата отписки': 25,
+    'Количество рассылок': 20,
+}
+DEFAULT_COLUMN_WIDTH = 15
+
+def _build_users_dataframe(users, columns):
     """
-    Генерирует Excel файл со статистикой по пользователям
+    Формирует таблицу пользователей для выгрузки
     
+    Преобразования выполняются целыми столбцами средствами pandas,
+    а не отдельно для каждого пользователя
+    
+    Args:
+        users (list): Документы пользователей
+        columns (dict): Поле пользователя -> заголовок столбца
+        
     Returns:
-        io.BytesIO: Excel файл в виде байтового потока
+        pd.DataFrame: Таблица с заголовками столбцов на русском языке
     """
-    logging.info("Начинаем генерацию Excel файла со статистикой")
+    df = pd.DataFrame(users).reindex(columns=list(columns))
     
-    # Получаем всех пользователей с постраничной загрузкой, чтобы снизить нагрузку на базу данных
-    batch_size = 1000  # Размер порции данных
-    all_users = []
-    skip = 0
+    text_fields = []
+    for field in columns:
+        if field in DATE_FIELDS:
+            df[field] = pd.to_datetime(df[field], errors='coerce').dt.strftime(DATE_FORMAT).fillna('')
+        else:
+            text_fields.append(field)
+    # Пропуски (в том числе в user_id) заменяем пустой строкой: xlsxwriter не записывает NaN
+    df[text_fields] = df[text_fields].fillna('')
     
-    while True:
-        logging.info(f"Загружаем пользователей (смещение: {skip}, лимит: {batch_size})")
-        users_batch = await get_all_users(limit=batch_size, skip=skip)
-        if not users_batch:
-            break
-            
-        all_users.extend(users_batch)
-        skip += batch_size
-        
-        if len(users_batch) < batch_size:
-            # Если количество пользователей в порции меньше размера порции, значит это последняя порция
-            break
+    return df.rename(columns=columns)
+
+def _write_excel(df, sheet_name):
+    """
+    Записывает таблицу в Excel файл
     
-    logging.info(f"Всего загружено {len(all_users)} пользователей")
+    Книга создается в режиме constant_memory: строки сбрасываются из памяти по мере записи,
+    поэтому таблица пишется построчно напрямую через xlsxwriter
+    (pandas.to_excel записывает ячейки по столбцам, что в этом режиме не поддерживается)
     
-    # Подготавливаем данные для Excel
-    data = []
-    for user in all_users:
-        # Формируем запись для каждого пользователя
-        row = {
-            'ID пользователя': user.get('user_id'),
-            'Имя': user.get('first_name', ''),
-            'Фамилия': user.get('last_name', ''),
-            'Юзернейм': user.get('username', ''),
-            'Телефон': user.get('phone', ''),
-            'Дата подписки': user.get('created_at', '').strftime('%d.%m.%Y %H:%M:%S') if user.get('created_at') else '',
-            'Дата активации': user.get('activated_at', '').strftime('%d.%m.%Y %H:%M:%S') if user.get('activated_at') else '',
-            'Дата отписки': user.get('deactivated_at', '').strftime('%d.%m.%Y %H:%M:%S') if user.get('deactivated_at') else '',
-            'Источник': user.get('source', ''),
-            'Статус': user.get('status', ''),
-            'Город': user.get('city', ''),
-        }
+    Args:
+        df (pd.DataFrame): Таблица для записи
+        sheet_name (str): Название листа
         
-        data.append(row)
+    Returns:
+        io.BytesIO: Excel файл в виде байтового потока
+    """
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    worksheet = workbook.add_worksheet(sheet_name)
     
-    # Создаем DataFrame
-    df = pd.DataFrame(data)
+    # Оформление заголовков как у pandas.to_excel
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for i, col in enumerate(df.columns):
+        worksheet.set_column(i, i, COLUMN_WIDTHS.get(col, DEFAULT_COLUMN_WIDTH))
+    worksheet.write_row(0, 0, list(df.columns), header_format)
     
-    # Загружаем данные о рассылках из базы батчами
-    db = get_db()
-    broadcasts_collection = db[BROADCASTS_COLLECTION]
+    for row_index, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_index, 0, row)
+    
+    workbook.close()
+    
+    # Переводим указатель на начало потока
+    output.seek(0)
+    return output
+
+def _build_excel_file(users, columns, sheet_name, broadcast_counts=None):
+    """
+    Формирует Excel файл со списком пользователей (синхронно, выполняется в отдельном потоке)
     
-    # Получаем общее количество рассылок для логирования
-    total_broadcasts = await broadcasts_collection.count_documents({})
-    logging.info(f"Общее количество рассылок: {total_broadcasts}")
+    Args:
+        users (list): Документы пользователей
+        columns (dict): Поле пользователя -> заголовок столбца
+        sheet_name (str): Название листа
+        broadcast_counts (Counter, optional): Telegram ID -> количество рассылок
+        
+    Returns:
+        io.BytesIO: Excel файл в виде байтового потока
+    """
+    df = _build_users_dataframe(users, columns)
+    if broadcast_counts is not None:
+        # Counter возвращает 0 для пользователей, не получивших ни одной рассылки,
+        # поэтому пропусков нет и столбец можно хранить как int32
+        df['Количество рассылок'] = df['ID пользователя'].map(broadcast_counts).astype('int32')
     
-    # Строим словарь с подсчетом рассылок на пользователя
-    user_broadcast_counts = {}
+    logging.info(f"Начинаем создание Excel файла для {len(df)} пользователей")
+    return _write_excel(df, sheet_name)
+
+async def _count_broadcasts_per_user():
+    """
+    Подсчитывает количество отправленных (или отправляемых) рассылок для каждого пользователя
     
-    for user in all_users:
-        user_id = user.get('user_id')
-        user_broadcast_counts[user_id] = {
-            'total_broadcasts': 0
-        }
+    Рассылки группируются по фильтру получателей, и для каждого уникального фильтра
+    пользователи выбираются одним запросом к MongoDB, а не сравнением в Python
     
-    # Получаем рассылки порциями для снижения нагрузки на память
-    broadcast_batch_size = 500
-    broadcast_skip = 0
+    Returns:
+        Counter: Telegram ID -> количество рассылок
+    """
+    broadcasts_collection = get_db()[BROADCASTS_COLLECTION]
     
-    while True:
-        logging.info(f"Загружаем рассылки (смещение: {broadcast_skip}, лимит: {broadcast_batch_size})")
-        broadcasts_batch = await broadcasts_collection.find({}).skip(broadcast_skip).limit(broadcast_batch_size).to_list(length=None)
-        
-        if not broadcasts_batch:
-            break
-            
-        # Подсчет рассылок
-        for broadcast in broadcasts_batch:
-            # Пропускаем незавершенные рассылки
-            if broadcast.get('status') not in ['completed', 'in_progress']:
-                continue
-                
-            target_filter = broadcast.get('target_filter', {})
-            if isinstance(target_filter, dict):
-                # Вместо того, чтобы делать запрос для каждой рассылки, мы проверяем соответствие пользователей фильтру прямо в коде
-                for user in all_users:
-                    user_id = user.get('user_id')
-                    if user_id in user_broadcast_counts:
-                        # Проверяем соответствие пользователя фильтру
-                        matches_filter = True
-                        for key, value in target_filter.items():
-                            if user.get(key) != value:
-                                matches_filter = False
-                                break
-                                
-                        if matches_filter:
-                            user_broadcast_counts[user_id]['total_broadcasts'] += 1
-            
-        broadcast_skip += broadcast_batch_size
-        
-        if len(broadcasts_batch) < broadcast_batch_size:
-            # Если количество рассылок в порции меньше размера порции, значит это последняя порция
-            break
-            
-        # Даем системе немного отдохнуть, чтобы не перегружать память и CPU
-        await asyncio.sleep(0.1)
+    # Количество рассылок для каждого уникального фильтра
+    filters = {}
+    filter_counts = Counter()
+    cursor = broadcasts_collection.find(
+        {"status": {"$in": ["completed", "in_progress"]}},
+        {"_id": 0, "target_filter": 1}
+    )
+    async for broadcast in cursor:
+        target_filter = broadcast.get('target_filter')
+        if target_filter is not None and not isinstance(target_filter, dict):
+            continue
+        # Тот же фильтр, что применяет send_broadcast: без явного статуса
+        # (в том числе у рассылок без фильтра) сообщение получают только активные пользователи
+        target_filter = dict(target_filter or {})
+        target_filter.setdefault('status', 'active')
+        key = json.dumps(target_filter, sort_keys=True, default=str)
+        filters[key] = target_filter
+        filter_counts[key] += 1
     
-    # Добавляем информацию о рассылках в DataFrame
-    broadcasts_data = []
-    for user_id, counts in user_broadcast_counts.items():
-        broadcasts_data.append({
-            'ID пользователя': user_id,
-            'Количество рассылок': counts['total_broadcasts']
-        })
+    logging.info(f"Рассылок для подсчета: {sum(filter_counts.values())}, уникальных фильтров: {len(filters)}")
     
-    broadcasts_df = pd.DataFrame(broadcasts_data)
+    broadcast_counts = Counter()
+    for key, target_filter in filters.items():
+        users_cursor = get_users_cursor(target_filter, projection={"user_id": 1, "_id": 0}, batch_size=USERS_BATCH_SIZE)
+        async for user in users_cursor:
+            broadcast_counts[user.get('user_id')] += filter_counts[key]
     
-    # Объединяем DataFrame с основной таблицей
-    if not broadcasts_df.empty:
-        df = df.merge(broadcasts_df, on='ID пользователя', how='left')
-    else:
-        df['Количество рассылок'] = 0
+    return broadcast_counts
+
+async def generate_users_statistics_excel():
+    """
+    Генерирует Excel файл со статистикой по пользователям
     
-    # Заполняем NA значения
-    df = df.fillna('')
+    Returns:
+        io.BytesIO: Excel файл в виде байтового потока
+    """
+    logging.info("Начинаем генерацию Excel файла со статистикой")
     
-    logging.info(f"Начинаем создание Excel файла для {len(df)} пользователей")
+    # Сначала считаем, сколько рассылок получил каждый пользователь
+    broadcast_counts = await _count_broadcasts_per_user()
     
-    # Создаем байтовый поток для Excel файла
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='Пользователи', index=False)
-        
-        # Настройка ширины столбцов
-        worksheet = writer.sheets['Пользователи']
-        for i, col in enumerate(df.columns):
-            # Для оптимизации не рассчитываем максимальную длину для больших наборов данных
-            # Просто устанавливаем стандартные ширины для известных столбцов
-            if col == 'ID пользователя':
-                worksheet.set_column(i, i, 15)
-            elif col in ['Имя', 'Фамилия', 'Юзернейм', 'Источник', 'Статус', 'Город']:
-                worksheet.set_column(i, i, 20)
-            elif col in ['Дата подписки', 'Дата активации', 'Дата отписки']:
-                worksheet.set_column(i, i, 25)
-            elif col == 'Количество рассылок':
-                worksheet.set_column(i, i, 20)
-            else:
-                worksheet.set_column(i, i, 15)
+    # Читаем пользователей одним курсором: в отличие от постраничной загрузки через skip
+    # сервер не пересканирует уже выданные документы
+    cursor = get_users_cursor(projection=USER_EXPORT_PROJECTION, batch_size=USERS_BATCH_SIZE)
+    users = [user async for user in cursor]
+    logging.info(f"Всего загружено {len(users)} пользователей")
     
-    # Переводим указатель на начало потока
-    output.seek(0)
+    # Таблица и Excel файл формируются в отдельном потоке, чтобы не блокировать event loop
+    output = await asyncio.to_thread(
+        _build_excel_file, users, USER_EXPORT_COLUMNS, 'Пользователи', broadcast_counts
+    )
     
     logging.info(f"Excel файл со статистикой успешно создан")
     
@@ -214,61 +267,14 @@ async def send_active_users_statistics_excel(message: types.Message):
         # Отправляем сообщение о процессе генерации
         await message.answer("⏳ Генерирую Excel файл со статистикой активных пользователей...")
         
-        # Получаем всех активных пользователей с постраничной загрузкой
-        batch_size = 1000
-        all_users = []
-        skip = 0
-        
-        while True:
-            users_batch = await get_all_users(status="active", limit=batch_size, skip=skip)
-            if not users_batch:
-                break
-                
-            all_users.extend(users_batch)
-            skip += batch_size
-            
-            if len(users_batch) < batch_size:
-                break
-        
-        # Подготавливаем данные для Excel
-        data = []
-        for user in all_users:
-            row = {
-                'ID пользователя': user.get('user_id'),
-                'Имя': user.get('first_name', ''),
-                'Фамилия': user.get('last_name', ''),
-                'Юзернейм': user.get('username', ''),
-                'Телефон': user.get('phone', ''),
-                'Дата подписки': user.get('created_at', '').strftime('%d.%m.%Y %H:%M:%S') if user.get('created_at') else '',
-                'Дата активации': user.get('activated_at', '').strftime('%d.%m.%Y %H:%M:%S') if user.get('activated_at') else '',
-                'Источник': user.get('source', ''),
-                'Город': user.get('city', ''),
-            }
-            data.append(row)
+        # Получаем активных пользователей одним курсором
+        cursor = get_users_cursor({"status": "active"}, projection=USER_EXPORT_PROJECTION, batch_size=USERS_BATCH_SIZE)
+        users = [user async for user in cursor]
         
-        # Создаем DataFrame и Excel
-        df = pd.DataFrame(data)
-        
-        # Создаем байтовый поток для Excel файла
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Активные пользователи', index=False)
-            
-            # Настройка ширины столбцов
-            worksheet = writer.sheets['Активные пользователи']
-            for i, col in enumerate(df.columns):
-                # Устанавливаем стандартные ширины для столбцов
-                if col == 'ID пользователя':
-                    worksheet.set_column(i, i, 15)
-                elif col in ['Имя', 'Фамилия', 'Юзернейм', 'Источник', 'Город']:
-                    worksheet.set_column(i, i, 20)
-                elif col in ['Дата подписки', 'Дата активации']:
-                    worksheet.set_column(i, i, 25)
-                else:
-                    worksheet.set_column(i, i, 15)
-        
-        # Переводим указатель на начало потока
-        output.seek(0)
+        # Создаем Excel файл в отдельном потоке, чтобы не блокировать event loop
+        output = await asyncio.to_thread(
+            _build_excel_file, users, ACTIVE_USER_EXPORT_COLUMNS, 'Активные пользователи'
+        )
         
         # Формируем название файла
         filename = f"active_users_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
@@ -276,7 +282,7 @@ async def send_active_users_statistics_excel(message: types.Message):
         # Отправляем файл
         await message.answer_document(
             types.InputFile(output, filename=filename),
-            caption=f"Статистика активных пользователей бота ({len(all_users)} пользователей)"
+            caption=f"Статистика активных пользователей бота ({len(users)} пользователей)"
         )
         
         logging.info(f"Excel-файл с активными пользователями успешно отправлен администратору {message.from_user.id}")